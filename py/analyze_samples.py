@@ -1,12 +1,108 @@
 #!/usr/bin/env python3.7
 
 import collections
+import hashlib
+import multiprocessing
+import os
 
 import cv2
+import numpy
 
 import autotents.common
 import autotents.digits
 
+
+# File name of pairwise match results, which lives in private directory.
+_PAIRWISE_CACHE_NAME = 'analysis_pairwise.npz'
+
+# Samples are padded by this many pixels in all directions before being matched against.
+_PADDING = 5
+
+
+def sample_hash(img):
+  """Hash of sample content, which identifies a sample regardless of its file name."""
+  h = hashlib.sha1()
+  h.update(f'{img.shape}'.encode())
+  h.update(img.tobytes())
+  return h.hexdigest()
+
+
+def load_pairwise_cache():
+  """Loads dict from (sample hash, pattern hash) to match result, which could be None."""
+  loc = autotents.common.private_path(_PAIRWISE_CACHE_NAME)
+  if not os.path.exists(loc):
+    return {}
+  with numpy.load(loc, allow_pickle=False) as packed:
+    pairs, values = packed['pairs'], packed['values']
+  return {
+    (str(h0), str(h1)): None if numpy.isnan(val) else float(val)
+    for (h0, h1), val in zip(pairs, values)
+  }
+
+
+def save_pairwise_cache(cache):
+  loc = autotents.common.private_path(_PAIRWISE_CACHE_NAME)
+  pairs = numpy.array(list(cache.keys()), dtype=str).reshape(-1, 2)
+  values = numpy.array([ numpy.nan if val is None else val for val in cache.values() ], dtype=numpy.float64)
+  tmp_loc = f'{loc}.tmp'
+  with open(tmp_loc, 'wb') as f:
+    numpy.savez(f, pairs=pairs, values=values)
+  os.replace(tmp_loc, loc)
+
+
+# samples by hash, set up in every worker process.
+_worker_samples = None
+
+
+def _init_worker(samples_by_hash):
+  global _worker_samples
+  _worker_samples = samples_by_hash
+  # parallelism comes from the pool, having OpenCV spawn threads on top of that only adds contention.
+  cv2.setNumThreads(1)
+
+
+def _match_row(task):
+  """Matches one sample against a list of patterns, all identified by hash."""
+  h0, pattern_hashes = task
+  # Apply padding in all directions, this is to:
+  # (1) simulate the situation that we need to match a pattern
+  # in an image that contains some extra empty parts.
+  # (2) allow some flexibility for matchTemplate
+  s_img = cv2.copyMakeBorder(
+    _worker_samples[h0],
+    _PADDING, _PADDING, _PADDING, _PADDING,
+    borderType=cv2.BORDER_CONSTANT,
+    value=0)
+  return [
+    ((h0, h1), autotents.common.rescale_and_match(s_img, _worker_samples[h1], autotents.common.TM_METHOD))
+    for h1 in pattern_hashes
+  ]
+
+
+def compute_pairwise(samples_by_hash):
+  """Computes match result of every pair of samples, only pairs missing from cache are computed.
+
+  Returns dict from (sample hash, pattern hash) to match result, which could be None.
+  """
+  cache = load_pairwise_cache()
+  hashes = sorted(samples_by_hash)
+  tasks = []
+  for h0 in hashes:
+    missing = [ h1 for h1 in hashes if (h0, h1) not in cache ]
+    if missing:
+      tasks.append((h0, missing))
+  pair_count = sum(len(missing) for _, missing in tasks)
+  print(f'Computing {pair_count} of {len(hashes) ** 2} pairs ...')
+  if tasks:
+    with multiprocessing.Pool(initializer=_init_worker, initargs=(samples_by_hash,)) as pool:
+      for row in pool.imap_unordered(_match_row, tasks):
+        cache.update(row)
+  # only pairs of current samples are kept, so that cache does not grow with samples removed.
+  results = { (h0, h1): cache[h0, h1] for h0 in hashes for h1 in hashes }
+  if tasks or len(results) != len(cache):
+    save_pairwise_cache(results)
+  return results
+
 # Here we focus on two numbers:
 # - what is the worst match inside the same tag (in-tag min),
 #   this measures how "spreaded" are those samples.
@@ -16,27 +112,18 @@ import autotents.digits
 def main_analyze_samples():
   """Analysis of collected samples."""
   tagged_samples = autotents.digits.manager.data
-  flat_samples = sum(
-    [[(tag, i, s)] for tag, samples in tagged_samples.items() for i, s in enumerate(samples)],
-    []
-  )
+  flat_samples = [
+    (tag, i, sample_hash(s), s)
+    for tag, samples in tagged_samples.items()
+    for i, s in enumerate(samples)
+  ]
   print(f'Sample count is: {len(flat_samples)}.')
+  pairwise = compute_pairwise({ h: s for _, _, h, s in flat_samples })
   # stores match in results[tag0, i0][tag1, i1]
   results = collections.defaultdict(dict)
-  for (tag0, i0, s_img_pre) in flat_samples:
-    padding = 5
-    # Apply padding in all directions, this is to:
-    # (1) simulate the situation that we need to match a pattern
-    # in an image that contains some extra empty parts.
-    # (2) allow some flexibility for matchTemplate
-    s_img = cv2.copyMakeBorder(
-      s_img_pre,
-      padding, padding, padding, padding,
-      borderType=cv2.BORDER_CONSTANT,
-      value=0)
-
-    for (tag1, i1, s_pat) in flat_samples:
-      val = autotents.common.rescale_and_match(s_img,s_pat, autotents.common.TM_METHOD)
+  for (tag0, i0, h0, _) in flat_samples:
+    for (tag1, i1, h1, _) in flat_samples:
+      val = pairwise[h0, h1]
       if val is None:
         continue
       results[tag0,i0][tag1,i1] = val
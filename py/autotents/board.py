@@ -0,0 +1,59 @@
+"""Views of a board on a screenshot.
+
+Every cell and digit is exposed as a slice of the screenshot, which numpy keeps as a strided view
+sharing memory with the screenshot, so no pixel is copied until something is written or concatenated.
+Grid lines are not equally thick, so cells are sliced one by one rather than as a single strided array.
+
+Mosaics, which do copy pixels, are only meant for debugging.
+"""
+
+import numpy
+
+
+class BoardView:
+
+  def __init__(self, img, geometry):
+    """geometry is an autotents.preset.Geometry of the board shown in img."""
+    self.img = img
+    self.geometry = geometry
+    self.size = len(geometry.row_bounds)
+
+  def __getitem__(self, pos):
+    """View of cell at (row, col)."""
+    r, c = pos
+    row_lo, row_hi = self.geometry.row_bounds[r]
+    col_lo, col_hi = self.geometry.col_bounds[c]
+    return self.img[row_lo:row_hi+1, col_lo:col_hi+1]
+
+  def rowDigit(self, i):
+    top, left, bottom, right = self.geometry.row_digit_rects[i]
+    return self.img[top:bottom, left:right]
+
+  def colDigit(self, i):
+    top, left, bottom, right = self.geometry.col_digit_rects[i]
+    return self.img[top:bottom, left:right]
+
+  def rowDigits(self):
+    return [ self.rowDigit(i) for i in range(self.size) ]
+
+  def colDigits(self):
+    return [ self.colDigit(i) for i in range(self.size) ]
+
+  def cellMosaic(self):
+    """All cells put next to each other without grid lines."""
+    return numpy.concatenate([
+      numpy.concatenate([ self[r, c] for c in range(self.size) ], axis=1)
+      for r in range(self.size)
+    ])
+
+  def digitMosaic(self):
+    """Row digits in one line, followed by column digits in another line."""
+    return numpy.concatenate([
+      numpy.concatenate(self.rowDigits(), axis=1),
+      numpy.concatenate(self.colDigits(), axis=1),
+    ])
+
+
+def tree_mosaic(trees):
+  """Shows result of find_trees as an image, every cell being a 4x4 block."""
+  return numpy.kron(trees, numpy.ones((4,4), dtype=numpy.uint8)) * 0xFF
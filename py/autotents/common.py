@@ -3,6 +3,9 @@
 import os
 
 import cv2
+import numpy
+
+import autotents.trace
 
 
 # This should point to a directory that stores assets not meant for source version control.
@@ -21,6 +24,10 @@ COLOR_DIGIT_SAT = (0x97, 0xa7, 0xc8)  # a satisfied digit
 COLOR_TREE_SHADE = (0x55, 0xc8, 0x87)  # A sample color for tree shade.
 COLOR_CELL_BLANK = (0x31, 0x31, 0x34)  # Color of a blank cell.
 
+# Screenshots are sampled at every COARSE_FACTOR-th pixel in both directions to locate the board,
+# so that only a small part of the board needs to be looked at in full resolution.
+COARSE_FACTOR = 8
+
 # We use CCOEFF here as we do want some penalty on mismatched bits
 # so that result is spreaded over a wider range so we have finer control using threshold.
 TM_METHOD = cv2.TM_CCOEFF_NORMED
@@ -47,7 +54,7 @@ def load_sample_by_name(name,screen_dim=PRESET_SCREEN_DIM):
 
 def load_sample(size,screen_dim=PRESET_SCREEN_DIM):
   """Loads screenshot sample of a specific size."""
-  return load_sample_by_name(f'sample-{size}x{size}.png')
+  return load_sample_by_name(f'sample-{size}x{size}.png', screen_dim)
 
 
 def find_exact_color(img, color):
@@ -55,7 +62,30 @@ def find_exact_color(img, color):
   return cv2.inRange(img, color, color)
 
 
-def rescale_and_match(img, templ_in, tm_method):
+def rescaled_template_height(templ_in, w):
+  """Height of a template after rescaling it to width w, keeping aspect ratio."""
+  templ_in_h, templ_in_w = templ_in.shape
+  return round(templ_in_h * w / templ_in_w)
+
+
+def rescale_template(templ_in, w):
+  """Rescales a template to width w, keeping aspect ratio."""
+  return cv2.resize(templ_in, (w, rescaled_template_height(templ_in, w)), cv2.INTER_AREA)
+
+
+def match_template(img, templ, tm_method):
+  """Matches a template against an image and returns the best score."""
+  result = cv2.matchTemplate(img, templ, tm_method)
+  _, max_val, _, _ = cv2.minMaxLoc(result)
+  return max_val
+
+
+def rescale_and_match(img, templ_in, tm_method, rescale=rescale_template):
+  """Rescales template to match image and then performs template matching.
+
+  rescale is called with template and target width to get the rescaled template,
+  this allows caller to substitute a cached version.
+  """
   (_,_,w,h) = cv2.boundingRect(img)
   if w == 0 or h == 0:
     return None
@@ -65,24 +95,72 @@ def rescale_and_match(img, templ_in, tm_method):
     # to match with multiple digit ones this way.
     # also because digits tend to vary more in horizontal direction
     # so we are actually eliminating lots of candidates this way.
-    templ_in_h, templ_in_w = templ_in.shape
-    scale = w / templ_in_w
-    templ_h = round(templ_in_h * w / templ_in_w)
-    if templ_h > h:
+    if rescaled_template_height(templ_in, w) > h:
       return None
-    templ = cv2.resize(templ_in, (w, templ_h), cv2.INTER_AREA)
+    templ = rescale(templ_in, w)
 
-  result = cv2.matchTemplate(img, templ, tm_method)
-  _, max_val, _, _ = cv2.minMaxLoc(result)
-  return max_val
+  return match_template(img, templ, tm_method)
 
 
-def extract_digits(img, cell_bounds):
-  h, w, _ = img.shape
+def find_board_region(img, factor=COARSE_FACTOR):
+  """Locates the board on a downscaled screenshot.
+
+  img is downscaled by taking every factor-th pixel, which keeps colors exact.
+  Rows of blank samples form bands, the board being the band that has most blank samples,
+  as rows of a board are only interrupted by grid lines, which leave at most one row without blank samples.
+
+  Returns (region, (r, c), pitch), all in full resolution, or None if nothing blank is found:
+
+  - region is (top, left, bottom, right), in which bottom and right are exclusive.
+    Every blank cell of the board is contained in region.
+  - (r, c) is the last blank sample on board, which is a pixel of a blank cell.
+  - pitch is (height, width) of an area centered at (r, c) that contains the cell.
+    Grid lines are thinner than factor and might be skipped, in which case this area covers a few cells.
+  """
+  h, w = img.shape[:2]
+  small = cv2.resize(img, (w // factor, h // factor), interpolation=cv2.INTER_NEAREST)
+  blank = find_exact_color(small, COLOR_CELL_BLANK) > 0
+  row_counts = numpy.count_nonzero(blank, axis=1)
+  rows = numpy.flatnonzero(row_counts)
+  if not len(rows):
+    return None
+  bands = numpy.split(rows, numpy.flatnonzero(numpy.diff(rows) > 2) + 1)
+  band = max(bands, key=lambda band: row_counts[band].sum())
+  top, bottom = int(band[0]), int(band[-1]) + 1
+  cols = numpy.flatnonzero(blank[top:bottom].any(axis=0))
+  left, right = int(cols[0]), int(cols[-1]) + 1
+
+  r = bottom - 1
+  c = int(numpy.flatnonzero(blank[r])[-1])
+  def run_extent(line, i):
+    # longest distance in samples from i to a non-blank sample or an end of line.
+    before = numpy.flatnonzero(~line[i::-1])
+    after = numpy.flatnonzero(~line[i:])
+    return max(int(before[0]) if len(before) else i + 1, int(after[0]) if len(after) else len(line) - i)
+  # cell might reach into pixels skipped next to a run, hence the extra sample on both sides.
+  pitch = tuple(
+    2 * (run_extent(line, i) + 1) * factor
+    for line, i in [(blank[:, c], r), (blank[r], c)]
+  )
+
+  # a blank cell reaches at most one sample past blank samples in it.
+  region = (
+    max(0, (top - 1) * factor), max(0, (left - 1) * factor),
+    min(h, (bottom + 1) * factor), min(w, (right + 1) * factor),
+  )
+  return region, (r * factor, c * factor), pitch
+
+
+def digit_rects(cell_bounds):
+  """Computes where digits are.
+
+  Returns (row digit rects, col digit rects), every rect is (top, left, bottom, right),
+  in which bottom and right are exclusive.
+  """
   row_bounds, col_bounds = cell_bounds
   max_cell_side = max(map(lambda x: x[1] - x[0] + 1, row_bounds + col_bounds))
-  def extract_digit(row,col):
-    return img[row:row+max_cell_side-1,col:col+max_cell_side-1]
+  def digit_rect(row,col):
+    return (row, col, row+max_cell_side-1, col+max_cell_side-1)
 
   # Suppose first two cells are A and B, we can then find a cell C if we extend
   # difference between A and B but in the other direction.
@@ -93,16 +171,91 @@ def extract_digits(img, cell_bounds):
   digit_col_start = max(0, 2 * col_bounds[0][0] - col_bounds[1][0])
 
   # digits accompanying every row.
-  row_digits = [
-    extract_digit(row_lo,digit_col_start)
+  row_rects = [
+    digit_rect(row_lo,digit_col_start)
     for row_lo, _ in row_bounds
   ]
   # same but for columns
-  col_digits = [
-    extract_digit(digit_row_start,col_lo)
+  col_rects = [
+    digit_rect(digit_row_start,col_lo)
     for col_lo, _ in col_bounds
   ]
-  return row_digits, col_digits
+  return row_rects, col_rects
+
+
+def tap_coords(cell_bounds):
+  """Computes center of every cell, result[r][c] is (x, y) of cell (r, c)."""
+  row_bounds, col_bounds = cell_bounds
+  return [
+    [ (round((col_lo + col_hi) / 2), round((row_lo + row_hi) / 2)) for col_lo, col_hi in col_bounds ]
+    for row_lo, row_hi in row_bounds
+  ]
+
+
+def board_bbox(cell_bounds):
+  """Computes (top, left, bottom, right) of the board, in which bottom and right are exclusive."""
+  row_bounds, col_bounds = cell_bounds
+  return (row_bounds[0][0], col_bounds[0][0], row_bounds[-1][1] + 1, col_bounds[-1][1] + 1)
+
+
+def crop_rects(img, rects):
+  return [ img[top:bottom, left:right] for top, left, bottom, right in rects ]
+
+
+def cell_rects(cell_bounds, positions):
+  """Computes (top, left, bottom, right) of cells at (row, col) positions, in which bottom and right are exclusive."""
+  row_bounds, col_bounds = cell_bounds
+  return [
+    (row_bounds[r][0], col_bounds[c][0], row_bounds[r][1] + 1, col_bounds[c][1] + 1)
+    for r, c in positions
+  ]
+
+
+def changed_fractions(before, after, rects):
+  """Computes fraction of pixels in every rect that differ between two images of the same screen."""
+  ret = []
+  for top, left, bottom, right in rects:
+    diff = cv2.absdiff(before[top:bottom, left:right], after[top:bottom, left:right])
+    changed = cv2.countNonZero(cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY))
+    ret.append(changed / ((bottom - top) * (right - left)))
+  return ret
+
+
+def has_unsat_digits(img, rects):
+  """Tells whether there is any unsatisfied digit in rects."""
+  return any(
+    cv2.countNonZero(find_exact_color(digit_img, COLOR_DIGIT_UNSAT)) > 0
+    for digit_img in crop_rects(img, rects)
+  )
+
+
+@autotents.trace.traced('extract_digits')
+def extract_digits(img, cell_bounds):
+  row_rects, col_rects = digit_rects(cell_bounds)
+  return crop_rects(img, row_rects), crop_rects(img, col_rects)
+
+
+@autotents.trace.traced('find_trees')
+def find_trees(img, cell_bounds):
+  """Finds trees on board in one pass.
+
+  Returns a boolean array of shape (rows, cols) where True indicates that the cell has a tree.
+  """
+  # bounds could also be arrays of shape (size, 2), as found in autotents.preset.Geometry.
+  row_bounds, col_bounds = map(numpy.asarray, cell_bounds)
+  top, left = row_bounds[0, 0], col_bounds[0, 0]
+  board = img[top:row_bounds[-1, 1]+1, left:col_bounds[-1, 1]+1]
+  shade = find_exact_color(board, COLOR_TREE_SHADE)
+  # with an integral image, sum over any cell can be done with 4 lookups.
+  integral = cv2.integral(shade)
+  row_lo = row_bounds[:, 0] - top
+  row_hi = row_bounds[:, 1] + 1 - top
+  col_lo = col_bounds[:, 0] - left
+  col_hi = col_bounds[:, 1] + 1 - left
+  per_cell = \
+    integral[numpy.ix_(row_hi, col_hi)] - integral[numpy.ix_(row_lo, col_hi)] \
+    - integral[numpy.ix_(row_hi, col_lo)] + integral[numpy.ix_(row_lo, col_lo)]
+  return per_cell != 0
 
 
 def crop_digit_cell(img):
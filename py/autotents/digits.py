@@ -2,31 +2,75 @@
 
 
 import collections
+import hashlib
+import json
 import os
 import re
 
 
 import cv2
+import numpy
 
 import autotents.common
+import autotents.trace
 
 
 _SAMPLE_FILENAME_PATTEN = re.compile(r'^([^_]+)_.*.png$')
 
+# File name of the packed sample store, which lives next to the sample directory.
+_PACKED_STORE_NAME = 'digits.npz'
+
+# Max number of rescaled templates kept in memory.
+_RESIZE_CACHE_SIZE = 1024
+
+# File name of the persistent recognition result cache, which lives in private directory next to packed store.
+# Search stats (see SampleManager.clearSearchStats) are kept in the same file.
+_RESULT_CACHE_NAME = 'digit_results.json'
+
+# Max number of recognition results kept.
+_RESULT_CACHE_SIZE = 4096
+
+
+# Search stops looking at other samples of a tag once a sample of it scores at least this much.
+_EARLY_EXIT_SCORE = 0.95
+
+
+ResizeCacheInfo = collections.namedtuple('ResizeCacheInfo', ['hits', 'misses', 'size', 'maxsize'])
+
+
+def _samples_fingerprint(store_path, tagged):
+  """Computes a fingerprint that changes whenever the set of tagged sample files changes."""
+  h = hashlib.sha1()
+  for _, filename in tagged:
+    st = os.stat(os.path.join(store_path, filename))
+    h.update(f'{filename}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+  return h.hexdigest()
+
 
 class SampleManager:
 
-  def __init__(self):
+  def __init__(self, resize_cache_size=_RESIZE_CACHE_SIZE, result_cache_size=_RESULT_CACHE_SIZE):
+    self.resize_cache_size = resize_cache_size
+    self.result_cache_size = result_cache_size
     self.load()
 
   def load(self):
     self.data = collections.defaultdict(list)
+    # cache is keyed by sample index so it must not outlive samples.
+    self.clearResizeCache()
+    self.clearSearchStats()
+    self.fingerprint = self.loadSamples()
+    self.loadResultCache()
+
+  def loadSamples(self):
+    """Loads tagged samples, returns fingerprint of the sample store or None if there is no store."""
     store_path = autotents.common.private_path('digits')
     if not os.path.exists(store_path):
-      return
+      return None
 
     untagged_count = 0
-    for filename in os.listdir(store_path):
+    tagged = []
+    for filename in sorted(os.listdir(store_path)):
       result = _SAMPLE_FILENAME_PATTEN.match(filename)
       if result is None:
         continue
@@ -34,26 +78,182 @@ class SampleManager:
       if tag == 'UNTAGGED':
         untagged_count += 1
         continue
-      self.data[tag].append(cv2.imread(os.path.join(store_path, filename),cv2.IMREAD_GRAYSCALE))
+      tagged.append((tag, filename))
     if untagged_count:
       print(f'There are {untagged_count} untagged samples.')
 
+    fingerprint = _samples_fingerprint(store_path, tagged)
+    if self.loadPacked(fingerprint):
+      return fingerprint
+    print('Packed sample store is stale, loading from sample directory ...')
+    for tag, filename in tagged:
+      self.data[tag].append(cv2.imread(os.path.join(store_path, filename),cv2.IMREAD_GRAYSCALE))
+    self.savePacked(fingerprint)
+    return fingerprint
+
+  def packedLocation(self):
+    return autotents.common.private_path(_PACKED_STORE_NAME)
+
+  def loadPacked(self, fingerprint):
+    """Loads samples from packed store, returns False if the store is missing or stale."""
+    loc = self.packedLocation()
+    if not os.path.exists(loc):
+      return False
+    with numpy.load(loc, allow_pickle=False) as packed:
+      if str(packed['fingerprint']) != fingerprint:
+        return False
+      tags, shapes, offsets, pixels = \
+        packed['tags'], packed['shapes'], packed['offsets'], packed['pixels']
+    for tag, (h, w), offset in zip(tags, shapes, offsets):
+      self.data[str(tag)].append(pixels[offset:offset+h*w].reshape(h, w))
+    return True
+
+  def savePacked(self, fingerprint):
+    """Writes all samples into a single file so that next load takes one read."""
+    tags, samples = [], []
+    for tag, tag_samples in self.data.items():
+      for img in tag_samples:
+        tags.append(tag)
+        samples.append(img)
+    shapes = numpy.array([img.shape for img in samples], dtype=numpy.int64).reshape(-1, 2)
+    lengths = shapes[:, 0] * shapes[:, 1]
+    offsets = numpy.cumsum(lengths) - lengths
+    pixels = numpy.concatenate([img.ravel() for img in samples]) if samples else numpy.zeros(0, dtype=numpy.uint8)
+    loc = self.packedLocation()
+    tmp_loc = f'{loc}.tmp'
+    with open(tmp_loc, 'wb') as f:
+      numpy.savez(
+        f,
+        fingerprint=numpy.array(fingerprint),
+        tags=numpy.array(tags, dtype=str),
+        shapes=shapes,
+        offsets=offsets,
+        pixels=pixels)
+    os.replace(tmp_loc, loc)
+
+  def clearResizeCache(self):
+    # (tag, sample index, target width) -> rescaled template, in LRU order.
+    self.resize_cache = collections.OrderedDict()
+    self.resize_cache_hits = 0
+    self.resize_cache_misses = 0
+
+  def resizeCacheInfo(self):
+    return ResizeCacheInfo(
+      self.resize_cache_hits, self.resize_cache_misses,
+      len(self.resize_cache), self.resize_cache_size)
+
+  def getRescaledTemplate(self, tag, i, w):
+    """Gets i-th sample of a tag rescaled to width w, resizing only on cache miss."""
+    key = (tag, i, w)
+    templ = self.resize_cache.get(key)
+    if templ is not None:
+      self.resize_cache_hits += 1
+      self.resize_cache.move_to_end(key)
+      return templ
+    self.resize_cache_misses += 1
+    autotents.trace.count('resizes')
+    templ = autotents.common.rescale_template(self.data[tag][i], w)
+    self.resize_cache[key] = templ
+    if len(self.resize_cache) > self.resize_cache_size:
+      self.resize_cache.popitem(last=False)
+    return templ
+
+  def resultCacheLocation(self):
+    return autotents.common.private_path(_RESULT_CACHE_NAME)
+
+  def loadResultCache(self):
+    """Loads recognition results and search stats, which are discarded if tagged samples have changed since they are saved."""
+    # crop hash -> (best_val, best_tag, competing_factor), in LRU order.
+    self.result_cache = collections.OrderedDict()
+    self.result_cache_dirty = False
+    loc = self.resultCacheLocation()
+    if self.fingerprint is None or not os.path.exists(loc):
+      return
+    with open(loc, 'r') as f:
+      raw = json.load(f)
+    if raw['fingerprint'] != self.fingerprint:
+      return
+    for key, best_val, best_tag, competing_factor in raw['results'][-self.result_cache_size:]:
+      self.result_cache[key] = (best_val, best_tag, competing_factor)
+    self.tag_hits.update(raw.get('tag_hits', {}))
+    for tag, i, hits in raw.get('sample_hits', []):
+      self.sample_hits[tag, i] = hits
+
+  def saveResultCache(self):
+    """Writes recognition results and search stats to disk if there are new ones."""
+    if not self.result_cache_dirty or self.fingerprint is None:
+      return
+    loc = self.resultCacheLocation()
+    # processes of multi-device mode may save at the same time, each writes its own temporary file.
+    tmp_loc = f'{loc}.{os.getpid()}.tmp'
+    with open(tmp_loc, 'w') as f:
+      json.dump({
+        'fingerprint': self.fingerprint,
+        'results': [ [key, *result] for key, result in self.result_cache.items() ],
+        'tag_hits': self.tag_hits,
+        'sample_hits': [ [tag, i, hits] for (tag, i), hits in self.sample_hits.items() ],
+      }, fp=f, separators=(',', ':'))
+    os.replace(tmp_loc, loc)
+    self.result_cache_dirty = False
+
+  def clearSearchStats(self):
+    # stats are saved along with result cache, so search order carries over to next process.
+    # tag -> # of times it is the best match.
+    self.tag_hits = collections.Counter()
+    # (tag, sample index) -> # of times it gives the best score of a match.
+    self.sample_hits = collections.Counter()
+
+  def orderedSamples(self):
+    """Yields (tag, sample index, sample), tags and samples that are more often the best match come first."""
+    for tag in sorted(self.data, key=lambda t: -self.tag_hits[t]):
+      samples = self.data[tag]
+      for i in sorted(range(len(samples)), key=lambda j: -self.sample_hits[tag, j]):
+        yield tag, i, samples[i]
+
+  def matchAll(self, img, tm_method, early_exit):
+    """Matches img against samples, returns a list of (val, tag, sample index) that are better than a threshold.
+
+    With early_exit, once a sample scores at least _EARLY_EXIT_SCORE, other samples of the same tag are skipped,
+    as they could only make the score slightly better. Every sample of other tags is still matched,
+    so competitors are found as they are without early exit.
+    """
+    good_values = []
+    match_count = 0
+    # (tag, sample index) of the sample that triggers early exit.
+    confident = None
+    for tag, i, pat in self.orderedSamples():
+      if confident is not None and tag == confident[0]:
+        continue
+      match_count += 1
+      val = autotents.common.rescale_and_match(
+        img, pat, tm_method,
+        rescale=lambda _, w: self.getRescaledTemplate(tag, i, w))
+      if val is None or val < autotents.common.RECOG_THRESHOLD:
+        continue
+      good_values.append((val, tag, i))
+      if early_exit and confident is None and val >= _EARLY_EXIT_SCORE:
+        confident = (tag, i)
+    autotents.trace.count('templates_matched', match_count)
+    return good_values, confident
+
   def findTagGray(self, img, tm_method=autotents.common.TM_METHOD):
     # first round: collect pairs that are better than a threshold.
-    good_values = []
-    for tag, samples in self.data.items():
-      for pat in samples:
-        val = autotents.common.rescale_and_match(img,pat,tm_method)
-        if val is None or val < autotents.common.RECOG_THRESHOLD:
-          continue
-        good_values.append((val, tag))
+    # _EARLY_EXIT_SCORE is a score of normalized correlation.
+    early_exit = tm_method == cv2.TM_CCOEFF_NORMED
+    good_values, confident = self.matchAll(img, tm_method, early_exit)
+    if confident is not None and any(tag != confident[0] for _, tag, _ in good_values):
+      # there are competitors, in which case best score of confident tag is needed to compute competing factor accurately.
+      good_values, _ = self.matchAll(img, tm_method, False)
     if not len(good_values):
       return None, None, None
     good_values = sorted(good_values, key=lambda x: x[0], reverse=True)
-    best_val, best_tag = good_values[0]
+    best_val, best_tag, best_i = good_values[0]
+    self.tag_hits[best_tag] += 1
+    self.sample_hits[best_tag, best_i] += 1
+    self.result_cache_dirty = True
     # find tags that are considered good by threshold but does not actually match
     # with the best tag, those are "competitors" that could potentially lead to inaccurate results.
-    competitors = [p for p in filter(lambda p: p[1] != best_tag, good_values)]
+    competitors = [(val, tag) for val, tag, _ in good_values if tag != best_tag]
     if not len(competitors):
       competing_factor = None
     else:
@@ -66,9 +266,31 @@ class SampleManager:
       assert competing_factor > 0
     return best_val, best_tag, competing_factor
 
-  def findTag(self, img_pre, tm_method=autotents.common.TM_METHOD):
+  @autotents.trace.traced('find_tag')
+  def findTag(self, img_pre, tm_method=autotents.common.TM_METHOD, use_cache=True):
+    """Recognizes a digit, returns (best_val, best_tag, competing_factor).
+
+    With use_cache, results are looked up by a hash of the cropped digit
+    (as done by autotents.common.crop_digit_cell) before doing any template matching.
+    New results are kept in memory until saveResultCache is called.
+    """
     img = autotents.common.find_exact_color(img_pre, autotents.common.COLOR_DIGIT_UNSAT)
-    return self.findTagGray(img, tm_method)
+    if not use_cache or tm_method != autotents.common.TM_METHOD or self.result_cache_size <= 0:
+      return self.findTagGray(img, tm_method)
+    (x,y,w,h) = cv2.boundingRect(img)
+    cropped = img[y:y+h,x:x+w]
+    key = hashlib.sha1(f'{cropped.shape}'.encode() + cropped.tobytes()).hexdigest()
+    result = self.result_cache.get(key)
+    if result is not None:
+      autotents.trace.count('result_cache_hits')
+      self.result_cache.move_to_end(key)
+      return result
+    result = self.findTagGray(img, tm_method)
+    self.result_cache[key] = result
+    self.result_cache_dirty = True
+    if len(self.result_cache) > self.result_cache_size:
+      self.result_cache.popitem(last=False)
+    return result
 
   def cleanUpUntagged(self):
     """Remove UNTAGGED sample if we can now find a good match."""
@@ -96,4 +318,19 @@ class SampleManager:
         os.remove(full_file_path)
 
 
-manager = SampleManager()
+_manager = None
+
+
+def get_manager():
+  """Gets the shared SampleManager, samples are loaded on first call."""
+  global _manager
+  if _manager is None:
+    _manager = SampleManager()
+  return _manager
+
+
+def __getattr__(name):
+  # `manager` is built on first access so that importing this module does not load any sample.
+  if name == 'manager':
+    return get_manager()
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
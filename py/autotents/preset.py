@@ -1,3 +1,4 @@
+import collections
 import json
 import os
 import re
@@ -6,6 +7,7 @@ import cv2
 import numpy
 
 import autotents.common
+import autotents.trace
 
 
 _RE_RAW_SIZE = re.compile(r'^(\d+)x\1$')
@@ -15,6 +17,31 @@ def _to_side_length_set(bounds):
     return { x[1] - x[0] + 1 for x in bounds }
 
 
+# Fields of precompiled geometry stored in preset alongside row_bounds and col_bounds.
+GEOMETRY_FIELDS = ['row_digit_rects', 'col_digit_rects', 'tap_coords', 'board_bbox']
+
+
+# Geometry of a board, all fields are numpy arrays:
+# - row_bounds, col_bounds: shape (size, 2), [lo, hi] of every row or column, inclusive.
+# - row_digit_rects, col_digit_rects: shape (size, 4), [top, left, bottom, right] of every digit, exclusive.
+# - tap_coords: shape (size, size, 2), tap_coords[r, c] is [x, y] of center of cell (r, c).
+# - board_bbox: shape (4,), [top, left, bottom, right] of the board, exclusive.
+Geometry = collections.namedtuple(
+  'Geometry',
+  ['row_bounds', 'col_bounds'] + GEOMETRY_FIELDS)
+
+
+def build_geometry(cell_bounds):
+  """Computes precompiled geometry from cell bounds, in the form stored in preset."""
+  row_digit_rects, col_digit_rects = autotents.common.digit_rects(cell_bounds)
+  return {
+    'row_digit_rects': row_digit_rects,
+    'col_digit_rects': col_digit_rects,
+    'tap_coords': autotents.common.tap_coords(cell_bounds),
+    'board_bbox': autotents.common.board_bbox(cell_bounds),
+  }
+
+
 class Preset:
 
   def __init__(self):
@@ -31,6 +58,16 @@ class Preset:
         self.data = json.load(f)
     else:
       self.data = {}
+    self.clearCaches()
+
+  def clearCaches(self):
+    # side length reverse maps keyed by screen_dim, built on demand.
+    self.side_length_rev_maps = {}
+    # cell bounds and geometry keyed by (size, screen_dim), built on demand.
+    self.cell_bounds_cache = {}
+    self.geometry_cache = {}
+    # rows of interest keyed by screen_dim, built on demand.
+    self.screen_rows = {}
 
   def save(self):
     print('Saving preset ...')
@@ -39,6 +76,18 @@ class Preset:
 
   def register(self, screen_dim_desc, cell_bounds_mapping):
     self.data[screen_dim_desc] = cell_bounds_mapping
+    self.clearCaches()
+    self.save()
+
+  def getTentColor(self, screen_dim):
+    """Gets mean (B,G,R) color of a cell with a tent on it, or None if it is not recorded (see gen_preset.py)."""
+    h, w = screen_dim
+    color = self.data.get('tent_colors', {}).get(f'{h}x{w}')
+    return None if color is None else tuple(color)
+
+  def registerTentColor(self, screen_dim, color):
+    h, w = screen_dim
+    self.data.setdefault('tent_colors', {})[f'{h}x{w}'] = list(color)
     self.save()
 
   def buildSideLengthRevMap(self, screen_dim):
@@ -55,33 +104,116 @@ class Preset:
         ret[x] = size
     return ret
 
+  def getSideLengthRevMap(self, screen_dim):
+    """Like buildSideLengthRevMap, but result is cached."""
+    ret = self.side_length_rev_maps.get(screen_dim)
+    if ret is None:
+      ret = self.buildSideLengthRevMap(screen_dim)
+      self.side_length_rev_maps[screen_dim] = ret
+    return ret
+
+  @autotents.trace.traced('find_board_size')
   def findBoardSize(self, img, screen_dim):
     h, w = screen_dim
-    result = autotents.common.find_exact_color(img, autotents.common.COLOR_CELL_BLANK)
-    mask = numpy.zeros((h+2,w+2), dtype=numpy.uint8)
-    side_length_rev_map = self.buildSideLengthRevMap(screen_dim)
-    # now we just need one empty cell for this to work,
-    # we can just search inside bounding rect and
-    # find the last empty cell so that we don't need to
-    # skip first box and then look at many filler lines.
-    r_x, r_y, r_w, r_h = cv2.boundingRect(result)
-    for r in reversed(range(r_y,r_y+r_h)):
-      for c in reversed(range(r_x,r_x+r_w)):
-        if (result[r,c] != 0):
-          x,y = c,r
-          retval, result, _, rect = cv2.floodFill(result, mask, (x,y), 0)
-          _, _, rect_w, _ = rect
-          if rect_w in side_length_rev_map:
-            return side_length_rev_map[rect_w]
-          else:
-            return None
+    side_length_rev_map = self.getSideLengthRevMap(screen_dim)
+    # now we just need one empty cell for this to work, which is located on a downscaled image first.
+    location = autotents.common.find_board_region(img)
+    if location is None:
+      return None
+    _, (r, c), pitch = location
+
+    # The flood fill then only needs a small window around (r,c) rather than the whole screen.
+    # pitch is usually just enough for a cell, but falls short if the cell has something on it,
+    # in which case we try again with a window that fits any cell.
+    max_side = max(side_length_rev_map)
+    full_pitch = 2 * max_side + 1
+    for win_pitch in [ tuple(min(x, full_pitch) for x in pitch), (full_pitch, full_pitch) ]:
+      pitch_h, pitch_w = win_pitch
+      lo_r, hi_r = max(0, r - pitch_h // 2), min(h, r + pitch_h // 2 + 1)
+      lo_c, hi_c = max(0, c - pitch_w // 2), min(w, c + pitch_w // 2 + 1)
+      window = autotents.common.find_exact_color(
+        img[lo_r:hi_r, lo_c:hi_c], autotents.common.COLOR_CELL_BLANK)
+      win_h, win_w = window.shape
+      mask = numpy.zeros((win_h+2,win_w+2), dtype=numpy.uint8)
+      _, _, _, rect = cv2.floodFill(window, mask, (c - lo_c, r - lo_r), 0)
+      rect_x, rect_y, rect_w, rect_h = rect
+      # region touching a window border that is not screen border might be cut by the window.
+      if (rect_x == 0 and lo_c > 0) or (rect_x + rect_w == win_w and hi_c < w) or \
+         (rect_y == 0 and lo_r > 0) or (rect_y + rect_h == win_h and hi_r < h):
+        continue
+      return side_length_rev_map.get(rect_w)
+    return None
 
   def getCellBounds(self, size, screen_dim):
+    key = (size, screen_dim)
+    ret = self.cell_bounds_cache.get(key)
+    if ret is None:
+      h, w = screen_dim
+      raw = self.data[f'{h}x{w}'][f'{size}x{size}']
+      row_bounds = list(map(lambda x: (x[0], x[1]), raw['row_bounds']))
+      col_bounds = list(map(lambda x: (x[0], x[1]), raw['col_bounds']))
+      ret = row_bounds, col_bounds
+      self.cell_bounds_cache[key] = ret
+    return ret
+
+  @autotents.trace.traced('get_geometry')
+  def getGeometry(self, size, screen_dim):
+    """Gets Geometry of a board, result is cached.
+
+    Geometry is computed from cell bounds if preset is generated before it was stored.
+    """
+    key = (size, screen_dim)
+    ret = self.geometry_cache.get(key)
+    if ret is None:
+      h, w = screen_dim
+      raw = self.data[f'{h}x{w}'][f'{size}x{size}']
+      cell_bounds = self.getCellBounds(size, screen_dim)
+      if not all(field in raw for field in GEOMETRY_FIELDS):
+        raw = build_geometry(cell_bounds)
+      row_bounds, col_bounds = cell_bounds
+      ret = Geometry(
+        row_bounds=numpy.array(row_bounds, dtype=numpy.int32),
+        col_bounds=numpy.array(col_bounds, dtype=numpy.int32),
+        **{ field: numpy.array(raw[field], dtype=numpy.int32) for field in GEOMETRY_FIELDS })
+      self.geometry_cache[key] = ret
+    return ret
+
+
+  def getScreenRows(self, screen_dim):
+    """Gets range of rows [top, bottom) that covers boards and digits of all sizes, or None if screen_dim is unknown.
+
+    Nothing outside of these rows is needed to find board size and recognize a board.
+    """
     h, w = screen_dim
-    raw = self.data[f'{h}x{w}'][f'{size}x{size}']
-    row_bounds = list(map(lambda x: (x[0], x[1]), raw['row_bounds']))
-    col_bounds = list(map(lambda x: (x[0], x[1]), raw['col_bounds']))
-    return row_bounds, col_bounds
+    screen_dim_raw = f'{h}x{w}'
+    if screen_dim_raw not in self.data:
+      return None
+    ret = self.screen_rows.get(screen_dim)
+    if ret is None:
+      tops, bottoms = [], []
+      for size_raw in self.data[screen_dim_raw]:
+        size = int(_RE_RAW_SIZE.match(size_raw).group(1))
+        geometry = self.getGeometry(size, screen_dim)
+        tops += [geometry.board_bbox[0], geometry.col_digit_rects[:, 0].min()]
+        bottoms += [geometry.board_bbox[2], geometry.row_digit_rects[:, 2].max()]
+      ret = (max(0, int(min(tops))), min(h, int(max(bottoms))))
+      self.screen_rows[screen_dim] = ret
+    return ret
+
+
+_preset = None
+
+
+def get_preset():
+  """Gets the shared Preset, preset.json is loaded on first call."""
+  global _preset
+  if _preset is None:
+    _preset = Preset()
+  return _preset
 
 
-preset = Preset()
+def __getattr__(name):
+  # `preset` is built on first access so that importing this module does not parse preset.json.
+  if name == 'preset':
+    return get_preset()
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,229 @@
+"""This module deals with storing recognized puzzles and their solutions.
+
+Puzzles are stored in a SQLite database, by default `private/puzzles.sqlite`,
+this can be changed by environment variable `PUZZLE_DB`.
+
+A puzzle is stored in the same format as input to tents-demo (see `puzzle_input_lines` in solver.py),
+and is deduplicated by its content. In addition, there are:
+
+- fingerprints: fingerprints of screenshots (see `board_fingerprint`) that are recognized as a puzzle.
+- recognitions: scores of recognized digits, one row per time a puzzle is recognized.
+- solves: time spent on recognizing and solving, one row per time a puzzle is solved.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import autotents.common
+
+
+_SCHEMA_VERSION = 2
+
+_SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS puzzles (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    puzzle TEXT NOT NULL,
+    solution TEXT,
+    seen_count INTEGER NOT NULL DEFAULT 1,
+    created REAL NOT NULL
+  )''',
+  'CREATE INDEX IF NOT EXISTS puzzles_size ON puzzles (size)',
+  '''CREATE TABLE IF NOT EXISTS fingerprints (
+    fingerprint TEXT PRIMARY KEY,
+    puzzle_id INTEGER NOT NULL REFERENCES puzzles (id)
+  )''',
+  '''CREATE TABLE IF NOT EXISTS recognitions (
+    id INTEGER PRIMARY KEY,
+    puzzle_id INTEGER NOT NULL REFERENCES puzzles (id),
+    min_score REAL,
+    scores TEXT NOT NULL,
+    created REAL NOT NULL
+  )''',
+  'CREATE INDEX IF NOT EXISTS recognitions_puzzle_id ON recognitions (puzzle_id)',
+  '''CREATE TABLE IF NOT EXISTS solves (
+    id INTEGER PRIMARY KEY,
+    puzzle_id INTEGER NOT NULL REFERENCES puzzles (id),
+    recognize_ms REAL NOT NULL,
+    solve_ms REAL NOT NULL,
+    created REAL NOT NULL
+  )''',
+  'CREATE INDEX IF NOT EXISTS solves_puzzle_id ON solves (puzzle_id)',
+]
+
+# header of every puzzle in legacy PUZZLE_RECORDS files.
+_RE_LEGACY_HEADER = re.compile(r'^# \S+$')
+
+
+def db_location():
+  return os.environ.get('PUZZLE_DB', autotents.common.private_path('puzzles.sqlite'))
+
+
+def board_fingerprint(img, screen_dim, size, geometry):
+  """Computes a fingerprint of the board shown in img.
+
+  Only trees and unsatisfied digits are looked at, which are what recognition is based on,
+  so that a board gets the same fingerprint every time it shows up.
+  geometry is an autotents.preset.Geometry.
+  """
+  h = hashlib.sha1()
+  h.update(f'{screen_dim}:{size}\n'.encode())
+  trees = autotents.common.find_trees(img, (geometry.row_bounds, geometry.col_bounds))
+  h.update(trees.tobytes())
+  for rects in [geometry.row_digit_rects, geometry.col_digit_rects]:
+    for digit_img in autotents.common.crop_rects(img, rects):
+      h.update(autotents.common.find_exact_color(digit_img, autotents.common.COLOR_DIGIT_UNSAT).tobytes())
+  return h.hexdigest()
+
+
+def content_hash(input_lines):
+  return hashlib.sha1('\n'.join(input_lines).encode()).hexdigest()
+
+
+def puzzle_size(input_lines):
+  """Size of a puzzle, from the first line of tents-demo input."""
+  rows, _ = map(int, input_lines[0].split())
+  return rows
+
+
+def parse_legacy_records(lines):
+  """Parses content of a PUZZLE_RECORDS file, returns a list of puzzles, each of which is a list of lines."""
+  ret = []
+  for line in lines:
+    line = line.rstrip('\n')
+    if _RE_LEGACY_HEADER.match(line):
+      ret.append([])
+    elif line and ret:
+      ret[-1].append(line)
+  return [ puzzle for puzzle in ret if puzzle ]
+
+
+class PuzzleStore:
+
+  def __init__(self, loc=None):
+    self.loc = db_location() if loc is None else loc
+    # loop mode opens store in main thread but uses it in a stage thread,
+    # store is never used by more than one thread at a time.
+    self.conn = sqlite3.connect(self.loc, check_same_thread=False)
+    with self.conn:
+      version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+      if version < _SCHEMA_VERSION:
+        self.migrate(version)
+        self.conn.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+
+  def close(self):
+    self.conn.close()
+
+  def migrate(self, version):
+    legacy = []
+    if version < 2:
+      # first version only has one table of puzzles keyed by fingerprint.
+      columns = [ row[1] for row in self.conn.execute('PRAGMA table_info(puzzles)') ]
+      if 'fingerprint' in columns:
+        legacy = self.conn.execute('SELECT fingerprint, puzzle, solution, created FROM puzzles').fetchall()
+        self.conn.execute('DROP TABLE puzzles')
+    for statement in _SCHEMA:
+      self.conn.execute(statement)
+    for fingerprint, puzzle, solution, created in legacy:
+      puzzle_id = self.insertPuzzle(puzzle.split('\n'), solution, created)
+      self.conn.execute(
+        'INSERT OR IGNORE INTO fingerprints (fingerprint, puzzle_id) VALUES (?, ?)', (fingerprint, puzzle_id))
+
+  def insertPuzzle(self, input_lines, solution, created):
+    """Inserts a puzzle or bumps its seen_count if it is already stored, returns its id.
+
+    solution is JSON-encoded tent positions, or None if not solved.
+    """
+    key = content_hash(input_lines)
+    row = self.conn.execute('SELECT id FROM puzzles WHERE content_hash = ?', (key,)).fetchone()
+    if row is None:
+      return self.conn.execute(
+        'INSERT INTO puzzles (content_hash, size, puzzle, solution, created) VALUES (?, ?, ?, ?, ?)',
+        (key, puzzle_size(input_lines), '\n'.join(input_lines), solution, created)).lastrowid
+    puzzle_id = row[0]
+    self.conn.execute(
+      'UPDATE puzzles SET seen_count = seen_count + 1, solution = COALESCE(?, solution) WHERE id = ?',
+      (solution, puzzle_id))
+    return puzzle_id
+
+  def findSolution(self, fingerprint):
+    """Looks up tent positions of a board by fingerprint, returns None if the board is not yet solved."""
+    row = self.conn.execute(
+      'SELECT puzzles.solution FROM fingerprints JOIN puzzles ON puzzles.id = fingerprints.puzzle_id'
+      ' WHERE fingerprints.fingerprint = ?', (fingerprint,)).fetchone()
+    if row is None or row[0] is None:
+      return None
+    return [ (r, c) for r, c in json.loads(row[0]) ]
+
+  def addPuzzle(self, input_lines):
+    """Stores a puzzle that is recognized but not solved, returns its id."""
+    with self.conn:
+      return self.insertPuzzle(input_lines, None, time.time())
+
+  def addSolved(self, fingerprint, input_lines, tent_positions, digit_scores, recognize_ms, solve_ms):
+    """Stores a solved puzzle together with how it is recognized and solved, returns its id.
+
+    digit_scores are scores of recognized digits, None for digits that are not matched against any sample.
+    """
+    now = time.time()
+    with self.conn:
+      puzzle_id = self.insertPuzzle(input_lines, json.dumps(tent_positions), now)
+      self.conn.execute(
+        'INSERT OR REPLACE INTO fingerprints (fingerprint, puzzle_id) VALUES (?, ?)', (fingerprint, puzzle_id))
+      scores = [ score for score in digit_scores if score is not None ]
+      self.conn.execute(
+        'INSERT INTO recognitions (puzzle_id, min_score, scores, created) VALUES (?, ?, ?, ?)',
+        (puzzle_id, min(scores, default=None), json.dumps(digit_scores), now))
+      self.conn.execute(
+        'INSERT INTO solves (puzzle_id, recognize_ms, solve_ms, created) VALUES (?, ?, ?, ?)',
+        (puzzle_id, recognize_ms, solve_ms, now))
+    return puzzle_id
+
+  def addPuzzles(self, puzzles):
+    """Stores puzzles in bulk, each puzzle is a list of lines. Returns # of puzzles that are new."""
+    now = time.time()
+    rows = [
+      (content_hash(input_lines), puzzle_size(input_lines), '\n'.join(input_lines), now)
+      for input_lines in puzzles
+    ]
+    with self.conn:
+      before = self.countPuzzles()
+      # every puzzle is inserted if new, otherwise counted as seen once more.
+      self.conn.executemany(
+        'INSERT OR IGNORE INTO puzzles (content_hash, size, puzzle, created, seen_count) VALUES (?, ?, ?, ?, 0)',
+        rows)
+      self.conn.executemany(
+        'UPDATE puzzles SET seen_count = seen_count + 1 WHERE content_hash = ?',
+        [ (key,) for key, _, _, _ in rows ])
+      return self.countPuzzles() - before
+
+  def importLegacyRecords(self, path):
+    """Imports a PUZZLE_RECORDS file, returns (# of puzzles in file, # of puzzles that are new)."""
+    with open(path, 'r') as f:
+      puzzles = parse_legacy_records(f)
+    return len(puzzles), self.addPuzzles(puzzles)
+
+  def countPuzzles(self):
+    return self.conn.execute('SELECT COUNT(*) FROM puzzles').fetchone()[0]
+
+  def findPuzzlesBySize(self, size):
+    """Returns a list of (id, lines of puzzle, tent positions or None) of puzzles of a specific size."""
+    return [
+      (puzzle_id, puzzle.split('\n'), None if solution is None else [ (r, c) for r, c in json.loads(solution) ])
+      for puzzle_id, puzzle, solution in self.conn.execute(
+        'SELECT id, puzzle, solution FROM puzzles WHERE size = ? ORDER BY id', (size,))
+    ]
+
+  def stats(self):
+    """Returns a list of (size, # of puzzles, # of solved puzzles, average solve_ms), ordered by size."""
+    return self.conn.execute(
+      'SELECT puzzles.size, COUNT(DISTINCT puzzles.id),'
+      ' COUNT(DISTINCT CASE WHEN puzzles.solution IS NOT NULL THEN puzzles.id END),'
+      ' AVG(solves.solve_ms)'
+      ' FROM puzzles LEFT JOIN solves ON solves.puzzle_id = puzzles.id'
+      ' GROUP BY puzzles.size ORDER BY puzzles.size').fetchall()
@@ -0,0 +1,70 @@
+"""Decoding of screenshots sent by input agent.
+
+A screenshot is either a PNG file, or a raw framebuffer as `screencap` outputs it without `-p`:
+a header of little-endian uint32s (width, height, pixel format, and color space on newer Android versions)
+followed by RGBA pixels.
+
+Raw framebuffers need no decompression, and are wrapped as numpy arrays without copying.
+Only rows that solver looks at need to be converted to BGR.
+"""
+
+import cv2
+import numpy
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Pixel format of RGBA_8888 in Android's framebuffer header.
+_RAW_FORMAT_RGBA_8888 = 1
+
+# Header is 3 uint32s on older Android versions and 4 since color space was added.
+_RAW_HEADER_SIZES = [12, 16]
+
+
+def is_png(data):
+  return bytes(data[:len(_PNG_SIGNATURE)]) == _PNG_SIGNATURE
+
+
+def parse_raw_framebuffer(data):
+  """Wraps a raw framebuffer as an RGBA array of shape (h, w, 4), which is a view of data."""
+  w, h, pixel_format = numpy.frombuffer(data, dtype='<u4', count=3)
+  assert pixel_format == _RAW_FORMAT_RGBA_8888, f'Unsupported pixel format {pixel_format}.'
+  header_size = len(data) - int(w) * int(h) * 4
+  assert header_size in _RAW_HEADER_SIZES, 'Size of raw framebuffer does not match its header.'
+  return numpy.frombuffer(data, dtype=numpy.uint8, offset=header_size).reshape(int(h), int(w), 4)
+
+
+def encode_raw_framebuffer(img):
+  """Encodes a BGR image as a raw framebuffer with a 16-byte header."""
+  h, w, _ = img.shape
+  header = numpy.array([w, h, _RAW_FORMAT_RGBA_8888, 0], dtype='<u4').tobytes()
+  return header + cv2.cvtColor(img, cv2.COLOR_BGR2RGBA).tobytes()
+
+
+def raw_to_bgr(rgba, rows=None):
+  """Converts RGBA array to BGR, only rows in range [top, bottom) are converted if rows is given.
+
+  Other rows are left black. As large zero-filled arrays are backed by pages
+  that are only allocated once written, these rows cost next to nothing.
+  """
+  h, w, _ = rgba.shape
+  if rows is None:
+    return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+  top, bottom = rows
+  img = numpy.zeros((h, w, 3), dtype=numpy.uint8)
+  img[top:bottom] = cv2.cvtColor(rgba[top:bottom], cv2.COLOR_RGBA2BGR)
+  return img
+
+
+def decode_screenshot(data, get_rows=None):
+  """Decodes a screenshot into a BGR image.
+
+  For raw framebuffers, get_rows is called with screen_dim,
+  and should return range of rows to convert or None to convert all of them.
+  """
+  if is_png(data):
+    return cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+  rgba = parse_raw_framebuffer(data)
+  h, w, _ = rgba.shape
+  rows = None if get_rows is None else get_rows((h, w))
+  return raw_to_bgr(rgba, rows)
@@ -0,0 +1,371 @@
+"""In-process solver for tents puzzles.
+
+This is an alternative to the external `tents-demo` binary. A board is represented
+by bitsets stored as Python ints, where cell (r,c) corresponds to bit r * cols + c,
+so that operations on all rows or all columns can be done at once by shifting.
+Search is done by constraint propagation and backtracking,
+while keeping track of which trees and tents are already paired.
+At every node of the search, cells are probed by propagating both possibilities,
+which decides cells that lead to a contradiction either way and picks the cell to branch on.
+"""
+
+import collections
+
+# int.bit_count is only available since Python 3.10.
+_popcount = getattr(int, 'bit_count', None) or (lambda x: bin(x).count('1'))
+
+
+def _bits(x):
+  """Yields indices of set bits."""
+  while x:
+    low = x & -x
+    yield low.bit_length() - 1
+    x ^= low
+
+
+def _pick_runs(x, step, mask, backward=False):
+  """Picks every other cell of every run, starting from first cell of a run.
+
+  A run is a maximal sequence of cells in x that are step apart.
+  mask should clear cells that a shift moves across the edge of the board.
+  A run of length k gets (k+1) // 2 cells picked, which is the max # of tents it can hold.
+  If backward is True, runs are picked starting from their last cell instead.
+  """
+  picks = 0
+  if backward:
+    while x:
+      heads = x & ~((x >> step) & mask)
+      x &= ~(heads | ((heads >> step) & mask))
+      picks |= heads
+  else:
+    while x:
+      heads = x & ~((x << step) & mask)
+      x &= ~(heads | ((heads << step) & mask))
+      picks |= heads
+  return picks
+
+
+class _Solver:
+  """Search state is a tuple of bitsets:
+
+  - tents: cells known to have a tent.
+  - empties: cells known to not have a tent (trees included).
+  - free_trees: trees that are not yet paired with a tent.
+  - free_tents: tents that are not yet paired with a tree.
+  """
+
+  def __init__(self, board, row_counts, col_counts):
+    self.rows, self.cols = rows, cols = len(board), len(board[0])
+    self.row_counts, self.col_counts = row_counts, col_counts
+    size = rows * cols
+    self.full = (1 << size) - 1
+
+    def neighbors(i):
+      r, c = divmod(i, cols)
+      for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        rr, cc = r + dr, c + dc
+        if 0 <= rr < rows and 0 <= cc < cols:
+          yield rr * cols + cc
+
+    self.tree_mask = sum(1 << (r * cols + c) for r in range(rows) for c in range(cols) if board[r][c] == 'R')
+    self.neigh4 = [ sum(1 << j for j in neighbors(i)) for i in range(size) ]
+    # tents can only be placed next to trees.
+    self.candidates = 0
+    for i in _bits(self.tree_mask):
+      self.candidates |= self.neigh4[i] & ~self.tree_mask
+
+    self.row_masks = [ ((1 << cols) - 1) << (r * cols) for r in range(rows) ]
+    self.col_masks = [ sum(1 << (r * cols + c) for r in range(rows)) for c in range(cols) ]
+    self.not_first_col = self.full & ~self.col_masks[0]
+    self.not_last_col = self.full & ~self.col_masks[-1]
+
+  def lineDeductions(self, tents, unknown, free_trees, free_tents, dirty):
+    """Applies row and column counts to lines that have a cell in dirty.
+
+    Other lines are not looked at, as nothing they depend on has changed since they were last looked at.
+    Returns (tents, empties) that must be added, or None on contradiction.
+    """
+    # tents are always isolated from unknown cells in all directions,
+    # so they count as runs of length 1.
+    avail = tents | unknown
+    new_tents = 0
+    new_empties = 0
+    dirty_rows, dirty_cols = set(), set()
+    for i in _bits(dirty):
+      r, c = divmod(i, self.cols)
+      dirty_rows.add(r)
+      dirty_cols.add(c)
+    for step, mask_fwd, mask_bwd, line_masks, counts, lines in [
+        (1, self.not_first_col, self.not_last_col, self.row_masks, self.row_counts, dirty_rows),
+        (self.cols, self.full, self.full, self.col_masks, self.col_counts, dirty_cols),
+    ]:
+      picks = _pick_runs(avail, step, mask_fwd)
+      picks_bwd = None
+      for k in lines:
+        line_mask, need = line_masks[k], counts[k]
+        placed = _popcount(tents & line_mask)
+        if placed > need:
+          return None
+        if placed == need:
+          new_empties |= unknown & line_mask
+          continue
+        capacity = _popcount(picks & line_mask)
+        if capacity < need:
+          return None
+        # every tent that is not yet paired needs a free tree next to it, and no two of them can share one.
+        unpaired = need - _popcount(tents & ~free_tents & line_mask)
+        if _popcount(self.adjacent4((unknown | free_tents) & line_mask) & free_trees) < unpaired:
+          return None
+        if capacity == need:
+          # every run of odd length is fully determined,
+          # those are exactly the cells picked in both directions.
+          if picks_bwd is None:
+            picks_bwd = _pick_runs(avail, step, mask_bwd, backward=True)
+          new_tents |= picks & picks_bwd & unknown & line_mask
+
+    # Within two adjacent rows, a column can have at most one tent
+    # and tents cannot be placed in adjacent columns, so those two rows
+    # together behave like a single line. Same goes for two adjacent columns.
+    rows_paired = (avail | (avail >> self.cols)) & ~self.row_masks[-1]
+    picks = _pick_runs(rows_paired, 1, self.not_first_col)
+    for r in { p for r in dirty_rows for p in [r - 1, r] if 0 <= p < self.rows - 1 }:
+      if _popcount(picks & self.row_masks[r]) < self.row_counts[r] + self.row_counts[r+1]:
+        return None
+    cols_paired = (avail | (avail >> 1)) & self.not_last_col
+    picks = _pick_runs(cols_paired, self.cols, self.full)
+    for c in { p for c in dirty_cols for p in [c - 1, c] if 0 <= p < self.cols - 1 }:
+      if _popcount(picks & self.col_masks[c]) < self.col_counts[c] + self.col_counts[c+1]:
+        return None
+
+    if new_tents & new_empties:
+      return None
+    return new_tents, new_empties
+
+  def shifted4(self, x):
+    """Returns x shifted in 4 directions, bit i of each result is set if the respective neighbor of i is in x."""
+    return (
+      (x << self.cols) & self.full,
+      x >> self.cols,
+      (x << 1) & self.not_first_col,
+      (x >> 1) & self.not_last_col,
+    )
+
+  def adjacent4(self, x):
+    """Cells next to any cell in x."""
+    a, b, c, d = self.shifted4(x)
+    return a | b | c | d
+
+  def adjacent8(self, x):
+    """Cells adjacent to any cell in x, including diagonally."""
+    horizontal = ((x << 1) & self.not_first_col) | ((x >> 1) & self.not_last_col)
+    spread = x | horizontal
+    return horizontal | ((spread << self.cols) & self.full) | (spread >> self.cols)
+
+  def countOptions(self, x):
+    """Returns cells that have at least one and at least two neighbors in x."""
+    a, b, c, d = self.shifted4(x)
+    return a | b | c | d, (a & (b | c | d)) | (b & (c | d)) | (c & d)
+
+  def propagate(self, state, pending, dirty):
+    """Applies rules until nothing changes.
+
+    pending are tents whose neighbors are not yet excluded.
+    dirty are cells that have changed since state was last propagated, or all cells if it never was.
+    Returns new state or None if a contradiction is found.
+    """
+    tents, empties, free_trees, free_tents = state
+    while True:
+      trees_before = free_trees
+      # no two tents can touch, not even diagonally.
+      if pending:
+        blocked = self.adjacent8(pending)
+        if blocked & tents:
+          return None
+        empties |= blocked
+        dirty |= blocked
+      unknown = self.full & ~tents & ~empties
+
+      # all deductions below are made from the same snapshot of tents and unknown cells.
+      result = self.lineDeductions(tents, unknown, free_trees, free_tents, dirty)
+      if result is None:
+        return None
+      new_tents, new_empties = result
+      free_tents |= new_tents
+
+      # every tent needs a tree of its own.
+      some, many = self.countOptions(free_trees)
+      if free_tents & ~some:
+        return None
+      for i in _bits(free_tents & ~many):
+        trees = self.neigh4[i] & free_trees
+        if not trees:
+          return None
+        free_trees &= ~trees
+        free_tents &= ~(1 << i)
+
+      # every tree needs a tent of its own.
+      options = (unknown | free_tents) & ~new_empties
+      some, many = self.countOptions(options)
+      if free_trees & ~some:
+        return None
+      for i in _bits(free_trees & ~many):
+        tree_options = self.neigh4[i] & options
+        if not tree_options:
+          return None
+        free_trees &= ~(1 << i)
+        options &= ~tree_options
+        if tree_options & free_tents:
+          free_tents &= ~tree_options
+        else:
+          new_tents |= tree_options
+
+      # a tent can only be placed next to a tree that is not yet paired.
+      new_empties |= unknown & ~self.countOptions(free_trees)[0] & ~new_tents
+
+      if new_tents & new_empties:
+        return None
+      # lines next to trees that just got paired have fewer trees to take tents from.
+      paired = trees_before & ~free_trees
+      if not new_tents and not (new_empties & unknown) and not paired:
+        return tents, empties, free_trees, free_tents
+      tents |= new_tents
+      empties |= new_empties
+      pending = new_tents
+      dirty = new_tents | (new_empties & unknown) | self.adjacent4(paired)
+
+  def canPair(self, sources, targets):
+    """Checks that every cell in sources can be paired with a distinct neighbor in targets."""
+    paired = {}
+    def augment(i, visited):
+      for j in _bits(self.neigh4[i] & targets & ~visited[0]):
+        visited[0] |= 1 << j
+        if j not in paired or augment(paired[j], visited):
+          paired[j] = i
+          return True
+      return False
+    return all(augment(i, [0]) for i in _bits(sources))
+
+  def canAssignLines(self, tents, unknown, free_trees, free_tents):
+    """Checks that every free tree can be given a tent so that every row, and every column, gets the # of tents it needs.
+
+    A free tree takes either a free tent next to it, or an unknown cell next to it, which counts towards line of that cell.
+    Whether two trees take the same cell, and whether tents touch each other, is not taken into account.
+    """
+    for line_masks, counts, line_of in [
+        (self.row_masks, self.row_counts, lambda i: i // self.cols),
+        (self.col_masks, self.col_counts, lambda i: i % self.cols),
+    ]:
+      # slot -> # of trees it takes, slots are lines (by index) and free tents (by # of lines + cell index).
+      capacity = {}
+      for k, (line_mask, need) in enumerate(zip(line_masks, counts)):
+        remaining = need - _popcount(tents & line_mask)
+        if remaining:
+          capacity[k] = remaining
+      for i in _bits(free_tents):
+        capacity[len(line_masks) + i] = 1
+      if sum(capacity.values()) != _popcount(free_trees):
+        return False
+      options = {}
+      for t in _bits(free_trees):
+        slots = { line_of(i) for i in _bits(self.neigh4[t] & unknown) if line_of(i) in capacity }
+        slots.update(len(line_masks) + i for i in _bits(self.neigh4[t] & free_tents))
+        options[t] = slots
+      # slot -> trees taking it.
+      assigned = collections.defaultdict(list)
+      def augment(t, visited):
+        for k in options[t]:
+          if k in visited:
+            continue
+          visited.add(k)
+          if len(assigned[k]) < capacity[k]:
+            assigned[k].append(t)
+            return True
+          for j, other in enumerate(assigned[k]):
+            if augment(other, visited):
+              assigned[k][j] = t
+              return True
+        return False
+      if not all(augment(t, set()) for t in sorted(options, key=lambda t: len(options[t]))):
+        return False
+    return True
+
+  def search(self, state, pending, dirty):
+    known_before = state[0] | state[1]
+    state = self.propagate(state, pending, dirty)
+    if state is None:
+      return None
+    tents, empties, free_trees, free_tents = state
+    unknown = self.full & ~tents & ~empties
+    # When both of these hold, there is a pairing that covers all free trees and all free tents.
+    if not self.canPair(free_tents, free_trees) or not self.canPair(free_trees, unknown | free_tents):
+      return None
+    if not unknown:
+      return tents
+
+    # probing: both possibilities of every unknown cell are propagated,
+    # a cell is decided right away if one of them leads to a contradiction.
+    # Otherwise # of cells decided by each possibility tells how much branching on that cell
+    # would narrow down the search, and the one that does the most is branched on.
+    # Only cells sharing a row or a column with cells decided since the parent node are probed,
+    # since probing elsewhere gives the same result as it did at the parent node.
+    changed = (tents | empties) & ~known_before | dirty
+    region = 0
+    for i in _bits(changed):
+      r, c = divmod(i, self.cols)
+      for rr in range(max(r - 1, 0), min(r + 2, self.rows)):
+        region |= self.row_masks[rr]
+      for cc in range(max(c - 1, 0), min(c + 2, self.cols)):
+        region |= self.col_masks[cc]
+    best_score, best = 0, None
+    for i in _bits(unknown & region):
+      bit = 1 << i
+      if not unknown & bit:
+        continue
+      as_tent = self.propagate((tents | bit, empties, free_trees, free_tents | bit), bit, bit)
+      as_empty = self.propagate((tents, empties | bit, free_trees, free_tents), 0, bit)
+      if as_tent is None and as_empty is None:
+        return None
+      if as_tent is None or as_empty is None:
+        tents, empties, free_trees, free_tents = as_tent or as_empty
+        unknown = self.full & ~tents & ~empties
+        continue
+      known = _popcount(tents | empties)
+      score = (_popcount(as_tent[0] | as_tent[1]) - known + 1) * (_popcount(as_empty[0] | as_empty[1]) - known + 1)
+      if score > best_score:
+        best_score, best = score, i
+    if not self.canPair(free_tents, free_trees) or not self.canPair(free_trees, unknown | free_tents):
+      return None
+    if not self.canAssignLines(tents, unknown, free_trees, free_tents):
+      return None
+    if not unknown:
+      return tents
+
+    # cells probed before the last contradiction might have been decided since.
+    i = best if best is not None and unknown >> best & 1 else next(_bits(unknown))
+    bit = 1 << i
+    result = self.search((tents | bit, empties, free_trees, free_tents | bit), bit, bit)
+    if result is not None:
+      return result
+    return self.search((tents, empties | bit, free_trees, free_tents), 0, bit)
+
+  def solve(self):
+    tree_count = _popcount(self.tree_mask)
+    if sum(self.row_counts) != tree_count or sum(self.col_counts) != tree_count:
+      return None
+    empties = self.full & ~self.candidates
+    tents = self.search((0, empties, self.tree_mask, 0), 0, self.full)
+    if tents is None:
+      return None
+    return [ divmod(i, self.cols) for i in _bits(tents) ]
+
+
+def solve(board, row_digits, col_digits):
+  """Solves a puzzle.
+
+  board is a list of rows, each of which is a sequence of 'R' (tree) or '?' (unknown).
+  row_digits and col_digits are recognized digit tags for rows and columns.
+  Returns a list of (row, col) for tents, or None if the puzzle has no solution.
+  """
+  row_counts = [ int(d) for d in row_digits ]
+  col_counts = [ int(d) for d in col_digits ]
+  return _Solver(board, row_counts, col_counts).solve()
@@ -0,0 +1,164 @@
+"""Lightweight tracing of the solving process.
+
+Tracing is enabled by setting environment variable `TRACE_FILE` to a file path.
+For every solving attempt, one JSON object is appended to that file as a single line,
+recording how many times each span is entered, how long it takes and counters like
+# of templates matched.
+
+When `TRACE_FILE` is not set, `traced` leaves functions as they are and
+all other functions here return right away.
+
+A trace is current to the thread that begins or resumes it, spans and counters
+outside of a current trace are ignored. A trace can be passed to another thread
+and resumed there, which is how stages of loop mode share one trace per board.
+"""
+
+import collections
+import functools
+import os
+import threading
+import time
+
+
+_TRACE_FILE = os.environ.get('TRACE_FILE')
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def enabled():
+  return _TRACE_FILE is not None
+
+
+class Trace:
+
+  def __init__(self, name):
+    self.name = name
+    self.wall_start = time.time()
+    self.start = time.perf_counter()
+    # span name -> [count, total seconds, max seconds]
+    self.spans = {}
+    self.counters = collections.Counter()
+    self.fields = {}
+
+  def addSpan(self, name, duration):
+    stat = self.spans.get(name)
+    if stat is None:
+      self.spans[name] = [1, duration, duration]
+    else:
+      stat[0] += 1
+      stat[1] += duration
+      stat[2] = max(stat[2], duration)
+
+  def toJson(self):
+    return {
+      'name': self.name,
+      'start': self.wall_start,
+      'total_ms': (time.perf_counter() - self.start) * 1000,
+      'spans': {
+        name: {'count': count, 'total_ms': total * 1000, 'max_ms': max_duration * 1000}
+        for name, (count, total, max_duration) in self.spans.items()
+      },
+      'counters': dict(self.counters),
+      **self.fields,
+    }
+
+
+class _Span:
+  __slots__ = ('trace', 'name', 'start')
+
+  def __init__(self, trace, name):
+    self.trace = trace
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.trace.addSpan(self.name, time.perf_counter() - self.start)
+    return False
+
+
+class _NullSpan:
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def current():
+  return getattr(_local, 'trace', None)
+
+
+def begin(name):
+  """Begins a new trace and makes it current, returns None if tracing is disabled."""
+  if _TRACE_FILE is None:
+    return None
+  trace = Trace(name)
+  _local.trace = trace
+  return trace
+
+
+def resume(trace):
+  """Makes a trace (which could be None) current to this thread."""
+  if _TRACE_FILE is None:
+    return
+  _local.trace = trace
+
+
+def finish(trace, **fields):
+  """Appends trace to `TRACE_FILE`, extra fields are included in output."""
+  if trace is None:
+    return
+  if current() is trace:
+    _local.trace = None
+  # json is only needed when tracing is enabled.
+  import json
+  trace.fields.update(fields)
+  line = json.dumps(trace.toJson(), sort_keys=True)
+  with _write_lock:
+    with open(_TRACE_FILE, 'a') as f:
+      print(line, file=f)
+
+
+def annotate(**fields):
+  """Attaches fields to current trace."""
+  trace = current()
+  if trace is not None:
+    trace.fields.update(fields)
+
+
+def span(name):
+  """Returns a context manager that measures time spent in it."""
+  trace = current()
+  if trace is None:
+    return _NULL_SPAN
+  return _Span(trace, name)
+
+
+def count(name, n=1):
+  trace = current()
+  if trace is not None:
+    trace.counters[name] += n
+
+
+def traced(name):
+  """Decorator that puts every call of a function in a span.
+
+  Function is returned unchanged if tracing is disabled.
+  """
+  def decorator(f):
+    if _TRACE_FILE is None:
+      return f
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+      with span(name):
+        return f(*args, **kwargs)
+    return wrapped
+  return decorator
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3.7
+"""Offline benchmark of board recognition.
+
+Every screenshot under `private/samples/{h}x{w}/` is recognized by the same code as solver
+(`solver.find_board` and `solver.recognize_board`), and time spent on each stage is collected
+through `autotents.trace` spans. Tracing is therefore always enabled here, traces are appended
+to `TRACE_FILE` if it is set and discarded otherwise.
+No sample is saved to digit store during this process, and digits not recognized confidently
+are reported through golden agreement rather than stopping the benchmark.
+Recognition result cache is not used unless asked to, so that every digit goes through template matching.
+
+Usage:
+
+- `./benchmark.py [cached]`: runs benchmark, reports latency per puzzle size,
+  and checks recognition results against golden output if there is one.
+  With `cached`, recognition result cache is used as solver does.
+  Report is saved to `private/benchmark/` so that it can be compared with later.
+- `./benchmark.py golden`: same as above, but then saves recognition results as golden output.
+- `./benchmark.py compare <old report> <new report>`: flags regressions from old to new.
+"""
+
+import collections
+import json
+import os
+import re
+import sys
+import time
+
+import numpy
+
+# spans are only recorded with tracing enabled, which has to be decided before autotents is imported.
+os.environ.setdefault('TRACE_FILE', os.devnull)
+
+import autotents.common
+import autotents.digits
+import autotents.preset
+import autotents.trace
+import solver
+
+
+_SAMPLE_FILE_PATTERN = re.compile(r'^.*\.png$', re.IGNORECASE)
+
+_RE_SCREEN_DIM = re.compile(r'^(\d+)x(\d+)$')
+
+# Every screenshot is recognized this many times, only the first round is done with a cold resize cache.
+_REPEAT = 3
+
+_PERCENTILES = [50, 90, 99]
+
+_STAGES = ['find_board_size', 'get_geometry', 'extract_digits', 'find_trees', 'find_tag']
+
+# Latency of a size is considered regressed when median grows by more than this ratio.
+_REGRESSION_TOLERANCE = 0.1
+
+
+def golden_location():
+  return autotents.common.private_path('benchmark_golden.json')
+
+
+def list_screenshots():
+  """Lists (screen_dim, file name) of screenshots for every screen dim known to preset."""
+  samples_path = autotents.common.private_path('samples')
+  ret = []
+  for screen_dim_raw in sorted(os.listdir(samples_path)):
+    result = _RE_SCREEN_DIM.match(screen_dim_raw)
+    if result is None or screen_dim_raw not in autotents.preset.preset.data:
+      continue
+    screen_dim = (int(result.group(1)), int(result.group(2)))
+    for fname in sorted(os.listdir(os.path.join(samples_path, screen_dim_raw))):
+      if _SAMPLE_FILE_PATTERN.match(fname) is not None:
+        ret.append((screen_dim, fname))
+  return ret
+
+
+def recognize(img, use_cache):
+  """Recognizes a screenshot in a trace of its own.
+
+  Returns (size, puzzle in tents-demo format as lines, finished autotents.trace.Trace),
+  or None if no board is found.
+  """
+  trace = autotents.trace.begin('benchmark')
+  found = solver.find_board(img)
+  if found is None:
+    autotents.trace.finish(trace)
+    return None
+  screen_dim, size = found
+  puzzle = solver.recognize_board(
+    img, screen_dim, size, save_samples=False, use_cache=use_cache, require_confident=False)
+  autotents.trace.finish(trace)
+  return size, solver.puzzle_input_lines(puzzle), trace
+
+
+def run_benchmark(use_cache=False):
+  # loaded before any timing takes place.
+  autotents.digits.get_manager()
+  autotents.preset.get_preset()
+
+  # (screen_dim, size) -> list of per-round stats
+  size_stats = collections.defaultdict(list)
+  outputs = {}
+  for screen_dim, fname in list_screenshots():
+    try:
+      img = autotents.common.load_sample_by_name(fname, screen_dim)
+    except AssertionError as e:
+      # file might be unreadable or of another screen dim.
+      print(f'Sample {fname} failed to load due to error {e}, skipping ...')
+      continue
+    h, w = screen_dim
+    key = f'{h}x{w}/{fname}'
+    for _ in range(_REPEAT):
+      start = time.perf_counter()
+      result = recognize(img, use_cache)
+      total = time.perf_counter() - start
+      if result is None:
+        print(f'Skipping sample {key} as we cannot determine its size ...')
+        break
+      size, lines, trace = result
+      # span name -> [count, total seconds, max seconds]
+      timings = { stage: trace.spans.get(stage, [0, 0.0, 0.0])[1] for stage in _STAGES }
+      digit_count = trace.spans.get('find_tag', [0])[0]
+      size_stats[screen_dim, size].append((total, timings, digit_count))
+      outputs[key] = lines
+
+  sizes = {}
+  for (screen_dim, size), stats in sorted(size_stats.items()):
+    h, w = screen_dim
+    totals_ms = numpy.array([ total for total, _, _ in stats ]) * 1000
+    find_tag_time = sum(timings['find_tag'] for _, timings, _ in stats)
+    digit_count = sum(count for _, _, count in stats)
+    sizes[f'{h}x{w}/{size}x{size}'] = {
+      'rounds': len(stats),
+      'latency_ms': {
+        f'p{p}': float(numpy.percentile(totals_ms, p))
+        for p in _PERCENTILES
+      },
+      'stage_p50_ms': {
+        stage: float(numpy.percentile([ timings[stage] * 1000 for _, timings, _ in stats ], 50))
+        for stage in _STAGES
+      },
+      'digits_per_second': digit_count / find_tag_time if find_tag_time > 0 else None,
+    }
+  return {'sizes': sizes, 'outputs': outputs}
+
+
+def check_agreement(outputs, golden):
+  """Returns (# of agreeing screenshots, list of keys that disagree)."""
+  agreed = 0
+  disagreed = []
+  for key, lines in sorted(golden.items()):
+    if outputs.get(key) == lines:
+      agreed += 1
+    else:
+      disagreed.append(key)
+  return agreed, disagreed
+
+
+def print_report(report):
+  for size_key, stat in report['sizes'].items():
+    latency = ', '.join(f'{k}={v:.1f}ms' for k, v in stat['latency_ms'].items())
+    digits_per_second = stat['digits_per_second']
+    digits_desc = 'n/a' if digits_per_second is None else f'{digits_per_second:.1f}'
+    print(f'{size_key}: {latency}, digits/s={digits_desc} ({stat["rounds"]} rounds)')
+    stages = ', '.join(f'{k}={v:.2f}ms' for k, v in stat['stage_p50_ms'].items())
+    print(f'  stage p50: {stages}')
+  agreement = report.get('agreement')
+  if agreement is not None:
+    print(f'Golden agreement: {agreement["agreed"]}/{agreement["total"]}.')
+    for key in agreement['disagreed']:
+      print(f'  Disagreement: {key}')
+
+
+def main_benchmark(update_golden=False, use_cache=False):
+  report = run_benchmark(use_cache)
+  golden_loc = golden_location()
+  if update_golden:
+    with open(golden_loc, 'w') as f:
+      json.dump(report['outputs'], fp=f, indent=2, sort_keys=True)
+    print(f'Golden output saved to {golden_loc}.')
+  elif os.path.exists(golden_loc):
+    with open(golden_loc, 'r') as f:
+      golden = json.load(f)
+    agreed, disagreed = check_agreement(report['outputs'], golden)
+    report['agreement'] = {'agreed': agreed, 'total': len(golden), 'disagreed': disagreed}
+  else:
+    print('No golden output is found, run `./benchmark.py golden` to create one.')
+  print_report(report)
+
+  report_path = autotents.common.private_path('benchmark')
+  if not os.path.exists(report_path):
+    os.makedirs(report_path)
+  report_loc = os.path.join(report_path, time.strftime('%Y%m%d-%H%M%S.json'))
+  with open(report_loc, 'w') as f:
+    json.dump(report, fp=f, indent=2, sort_keys=True)
+  print(f'Report saved to {report_loc}.')
+
+
+def compare_reports(old, new):
+  """Returns a list of regressions found in new report compared to old one."""
+  regressions = []
+  for size_key, new_stat in new['sizes'].items():
+    old_stat = old['sizes'].get(size_key)
+    if old_stat is None:
+      continue
+    old_p50, new_p50 = old_stat['latency_ms']['p50'], new_stat['latency_ms']['p50']
+    if new_p50 > old_p50 * (1 + _REGRESSION_TOLERANCE):
+      regressions.append(f'{size_key}: p50 latency {old_p50:.1f}ms -> {new_p50:.1f}ms')
+  for key, old_lines in sorted(old['outputs'].items()):
+    if key in new['outputs'] and new['outputs'][key] != old_lines:
+      regressions.append(f'{key}: recognition result changed')
+  old_agreement, new_agreement = old.get('agreement'), new.get('agreement')
+  if old_agreement is not None and new_agreement is not None \
+     and new_agreement['agreed'] < old_agreement['agreed']:
+    regressions.append(f'golden agreement {old_agreement["agreed"]} -> {new_agreement["agreed"]}')
+  return regressions
+
+
+def main_compare(old_loc, new_loc):
+  with open(old_loc, 'r') as f:
+    old = json.load(f)
+  with open(new_loc, 'r') as f:
+    new = json.load(f)
+  regressions = compare_reports(old, new)
+  for regression in regressions:
+    print(f'Regression: {regression}')
+  if regressions:
+    sys.exit(1)
+  print('No regression found.')
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  if not args:
+    main_benchmark()
+  elif args == ['cached']:
+    main_benchmark(use_cache=True)
+  elif args == ['golden']:
+    main_benchmark(update_golden=True)
+  elif len(args) == 3 and args[0] == 'compare':
+    main_compare(args[1], args[2])
+  else:
+    print(__doc__)
+    sys.exit(1)
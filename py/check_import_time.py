@@ -0,0 +1,54 @@
+#!/usr/bin/env python3.7
+"""Checks that importing autotents modules stays within a time budget.
+
+Only self time of autotents modules is counted, as third party libraries
+like cv2 and numpy are needed by every tool regardless.
+Assets (digit samples and preset) should be loaded on first use rather than on import,
+this is what this budget is guarding.
+"""
+
+import re
+import subprocess
+import sys
+
+
+# Budget for self time of all autotents modules combined, in microseconds.
+IMPORT_TIME_BUDGET_US = 20000
+
+_MODULES = ['autotents.common', 'autotents.digits', 'autotents.preset']
+
+_RE_IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)$')
+
+
+def measure_import_time(modules):
+  """Imports modules in a fresh process and returns self time (in microseconds) of every module imported."""
+  proc = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', f'import {", ".join(modules)}'],
+    text=True,
+    capture_output=True,
+    check=True,
+  )
+  ret = {}
+  for line in proc.stderr.splitlines():
+    result = _RE_IMPORT_TIME.match(line)
+    if result is None:
+      continue
+    ret[result.group(3)] = int(result.group(1))
+  return ret
+
+
+def main_check_import_time():
+  self_times = measure_import_time(_MODULES)
+  total = 0
+  for name, self_time in sorted(self_times.items()):
+    if name == 'autotents' or name.startswith('autotents.'):
+      print(f'{name}: {self_time} us')
+      total += self_time
+  print(f'Total: {total} us, budget: {IMPORT_TIME_BUDGET_US} us.')
+  if total > IMPORT_TIME_BUDGET_US:
+    print('Import time budget exceeded.')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main_check_import_time()
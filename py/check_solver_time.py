@@ -0,0 +1,139 @@
+#!/usr/bin/env python3.7
+"""Checks that the builtin solver (autotents.tents) stays within a time budget.
+
+Boards are randomly generated with a fixed seed, so every run solves the same boards.
+A board is generated by placing tents that do not touch each other, each with a tree
+next to it, so it always has a solution but not necessarily a unique one.
+Tent density ranges from sparse boards to what boards of the game have (about one tree every five cells).
+Every solution found is checked against the rules, then time spent on the slowest board is
+checked against SOLVE_TIME_BUDGET_MS.
+
+Usage: `./check_solver_time.py [# of boards]`
+"""
+
+import random
+import sys
+import time
+
+import numpy
+
+import autotents.tents
+
+
+# Budget for the slowest board, in milliseconds.
+SOLVE_TIME_BUDGET_MS = 2000
+
+_SIZES = [20, 21, 22]
+
+# Range of # of tents over # of cells.
+_DENSITY_RANGE = (0.12, 0.2)
+
+_BOARD_COUNT = 150
+
+_SEED = 20261017
+
+_PERCENTILES = [50, 90, 99]
+
+
+def generate_board(rng, size, tent_count):
+  """Generates a board with at most tent_count tents, returns (board, row_digits, col_digits).
+
+  board and digits are in the same format autotents.tents.solve takes.
+  """
+  board = [ ['?'] * size for _ in range(size) ]
+  tents = set()
+  cells = [ (r, c) for r in range(size) for c in range(size) ]
+  rng.shuffle(cells)
+  for r, c in cells:
+    if len(tents) >= tent_count:
+      break
+    if board[r][c] != '?' or (r, c) in tents:
+      continue
+    if any((r + dr, c + dc) in tents for dr in [-1, 0, 1] for dc in [-1, 0, 1]):
+      continue
+    trees = [
+      (rr, cc) for rr, cc in [(r-1, c), (r+1, c), (r, c-1), (r, c+1)]
+      if 0 <= rr < size and 0 <= cc < size and board[rr][cc] == '?' and (rr, cc) not in tents
+    ]
+    if not trees:
+      continue
+    tr, tc = rng.choice(trees)
+    board[tr][tc] = 'R'
+    tents.add((r, c))
+  row_digits = [ str(sum(r == i for r, _ in tents)) for i in range(size) ]
+  col_digits = [ str(sum(c == i for _, c in tents)) for i in range(size) ]
+  return board, row_digits, col_digits
+
+
+def check_solution(board, row_digits, col_digits, tent_positions):
+  """Checks tent positions against rules of the puzzle, returns an error message or None."""
+  size = len(board)
+  tents = set(map(tuple, tent_positions))
+  if len(tents) != len(tent_positions):
+    return 'duplicated tents'
+  if any(board[r][c] == 'R' for r, c in tents):
+    return 'tent placed on a tree'
+  if [ str(sum(r == i for r, _ in tents)) for i in range(size) ] != list(row_digits):
+    return 'row counts do not match'
+  if [ str(sum(c == i for _, c in tents)) for i in range(size) ] != list(col_digits):
+    return 'column counts do not match'
+  for r, c in tents:
+    if any((r + dr, c + dc) in tents for dr in [-1, 0, 1] for dc in [-1, 0, 1] if (dr, dc) != (0, 0)):
+      return f'tent at {(r, c)} touches another tent'
+  # every tree needs a tent of its own, which is a bipartite matching that covers all trees.
+  trees = [ (r, c) for r in range(size) for c in range(size) if board[r][c] == 'R' ]
+  if len(trees) != len(tents):
+    return 'tents do not pair up with trees'
+  paired = {}
+  def augment(tree, visited):
+    r, c = tree
+    for tent in [(r-1, c), (r+1, c), (r, c-1), (r, c+1)]:
+      if tent in tents and tent not in visited:
+        visited.add(tent)
+        if tent not in paired or augment(paired[tent], visited):
+          paired[tent] = tree
+          return True
+    return False
+  if not all(augment(tree, set()) for tree in trees):
+    return 'tents do not pair up with trees'
+  return None
+
+
+def main_check_solver_time(board_count=_BOARD_COUNT):
+  rng = random.Random(_SEED)
+  # list of (milliseconds, size, # of tents)
+  results = []
+  failures = 0
+  for _ in range(board_count):
+    size = rng.choice(_SIZES)
+    tent_count = round(size * size * rng.uniform(*_DENSITY_RANGE))
+    board, row_digits, col_digits = generate_board(rng, size, tent_count)
+    start = time.perf_counter()
+    tent_positions = autotents.tents.solve(board, row_digits, col_digits)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    tent_count = sum(map(int, row_digits))
+    results.append((elapsed_ms, size, tent_count))
+    error = 'no solution found' if tent_positions is None else \
+      check_solution(board, row_digits, col_digits, tent_positions)
+    if error is not None:
+      failures += 1
+      print(f'{size}x{size} board with {tent_count} tents: {error}')
+
+  elapsed_ms = numpy.array([ ms for ms, _, _ in results ])
+  percentiles = ', '.join(f'p{p}={numpy.percentile(elapsed_ms, p):.1f}ms' for p in _PERCENTILES)
+  worst_ms, worst_size, worst_tents = max(results)
+  print(f'{len(results)} boards solved, {failures} wrong. {percentiles}.')
+  print(f'Slowest: {worst_ms:.1f}ms on a {worst_size}x{worst_size} board with {worst_tents} tents, budget: {SOLVE_TIME_BUDGET_MS}ms.')
+  if failures:
+    sys.exit(1)
+  if worst_ms > SOLVE_TIME_BUDGET_MS:
+    print('Solve time budget exceeded.')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  if len(args) > 1:
+    print(__doc__)
+    sys.exit(1)
+  main_check_solver_time(int(args[0]) if args else _BOARD_COUNT)
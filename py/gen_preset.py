@@ -1,8 +1,10 @@
 #!/usr/bin/env python3.7
 
 import collections
+import hashlib
 import json
-import multiprocessing
+import os
+import sys
 
 import cv2
 import numpy
@@ -48,8 +50,20 @@ def resolve_stat(d, size, threshold=3):
   return map(ave, grouping)
 
 
-def find_cell_bounds(img, size=None):
-  h, w, _ = img.shape
+def find_cell_bounds(img, size=None, coarse=True):
+  """Finds bounds of every cell, returns (row bounds, col bounds).
+
+  With coarse, board is located on a downscaled image first (see autotents.common.find_board_region),
+  and only the region containing it is looked at in full resolution.
+  Otherwise the whole screenshot is looked at, and the first blank region in row-major order
+  is taken as difficulty box and skipped.
+  """
+  top, left = 0, 0
+  if coarse:
+    location = autotents.common.find_board_region(img)
+    assert location is not None, 'No blank cell is found.'
+    (top, left, bottom, right), _, _ = location
+    img = img[top:bottom, left:right]
   result = autotents.common.find_exact_color(
     img,
     autotents.common.COLOR_CELL_BLANK
@@ -63,35 +77,39 @@ def find_cell_bounds(img, size=None):
   col_begins_stat = mk_stat()
   col_ends_stat = mk_stat()
 
-  mask = numpy.zeros((h+2,w+2), dtype=numpy.uint8)
-
-  # skip first region encountered, which is likely just the difficulty box
-  # on the top right corner.
-  first_skipped = False
-  for r in range(h):
-    for c in range(w):
-      if (result[r,c] != 0):
-        x,y = c,r
-        retval, result, _, rect = cv2.floodFill(result, mask, (x,y), 0)
-        rect_x, rect_y, rect_w, rect_h = rect
-
-        # We are getting some 1-pixel noise on 5x5 puzzles,
-        # in order to eliminate those, we ignore detected rectangles
-        # if it is too small (in this case, 5 pixels in width or height)
-        if rect_w <= 5 or rect_h <= 5:
-          continue
-
-        if not first_skipped:
-          first_skipped = True
-          continue
-
-        row_begins_stat[rect_y] += 1
-        col_begins_stat[rect_x] += 1
-
-        rect_x_end = rect_x + rect_w - 1
-        rect_y_end = rect_y + rect_h - 1
-        row_ends_stat[rect_y_end] += 1
-        col_ends_stat[rect_x_end] += 1
+  # Label all blank regions in one go, this is equivalent to
+  # flood-filling (4-connectivity) every region we come across.
+  label_count, labels, stats, _ = cv2.connectedComponentsWithStats(
+    result, connectivity=4, ltype=cv2.CV_32S)
+  # label 0 is the background.
+  rects = stats[1:label_count, :4]
+
+  # We are getting some 1-pixel noise on 5x5 puzzles,
+  # in order to eliminate those, we ignore detected rectangles
+  # if it is too small (in this case, 5 pixels in width or height)
+  keep = numpy.flatnonzero((rects[:, 2] > 5) & (rects[:, 3] > 5))
+
+  # skip first region encountered in row-major order, which is likely just the difficulty box
+  # on the top right corner. Label numbering is not guaranteed to follow scanning order,
+  # so we locate first pixel of every candidate region explicitly.
+  if len(keep) and not coarse:
+    def first_pixel(i):
+      rect_x, rect_y, rect_w, _ = rects[i]
+      row = labels[rect_y, rect_x:rect_x+rect_w]
+      return rect_y, rect_x + int(numpy.argmax(row == i + 1))
+    first = min(keep, key=first_pixel)
+    keep = keep[keep != first]
+
+  rect_xs, rect_ys, rect_ws, rect_hs = rects[keep].T
+  rect_xs, rect_ys = rect_xs + left, rect_ys + top
+  for stat, coords in [
+      (row_begins_stat, rect_ys),
+      (col_begins_stat, rect_xs),
+      (row_ends_stat, rect_ys + rect_hs - 1),
+      (col_ends_stat, rect_xs + rect_ws - 1),
+  ]:
+    for coord, count in zip(*numpy.unique(coords, return_counts=True)):
+      stat[int(coord)] += int(count)
 
   def make_bounds(begin_stat, end_stat):
     begin_coords = map(round, resolve_stat(begin_stat, size))
@@ -108,38 +126,100 @@ def find_cell_bounds(img, size=None):
   return row_bounds, col_bounds
 
 
-def _generate_preset_for_size(size):
-  img = autotents.common.load_sample(size)
+def sample_location(size, screen_dim):
+  h, w = screen_dim
+  return autotents.common.private_path('samples', f'{h}x{w}', f'sample-{size}x{size}.png')
+
+
+def file_hash(loc):
+  with open(loc, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def _generate_preset_for_size(size, screen_dim, source_hash):
+  img = autotents.common.load_sample(size, screen_dim)
   cell_bounds = find_cell_bounds(img, size)
   row_bounds, col_bounds = cell_bounds
   bound_info =  {
     'row_bounds': row_bounds,
     'col_bounds': col_bounds,
+    'source_hash': source_hash,
+    **autotents.preset.build_geometry(cell_bounds),
   }
   return f'{size}x{size}', bound_info
 
 
-# Given that most of the processing time is spent on doing floodFill to figure out cell bounds,
-# it makes sense that we have this info pre-processed. In order to achieve so, we must extract size of the board.
+# While figuring out cell bounds is now a single labeling pass, it still
+# makes sense that we have this info pre-processed. In order to achieve so, we must extract size of the board.
 # Note that despite regular puzzle shows size info (size x size), daily puzzles do not.
 # Fortunately all puzzle of different sizes use cells of different side length as well,
 # therefore once we know the side length of an empty cell, we can map it back to puzzle size.
 # (assuming that all puzzles are squares)
-def main_generate_preset():
+#
+# Preset is built incrementally: every size records hash of the sample it is generated from,
+# only sizes whose sample is new or changed are processed again, unless force is True.
+def main_generate_preset(force=False):
   # schema:
   # top level is an Object keyed by screen width and height i.e. "1440x2880"
   # then values are Object keyed by size e.g. "16x16", which is then keyed by "row_bounds" and "col_bounds",
-  # which are Arrays whose elements are Arrays of two elements [lo, hi].
+  # which are Arrays whose elements are Arrays of two elements [lo, hi],
+  # and "source_hash", which is SHA-1 of the sample file.
+  # Geometry derived from bounds is stored as well so solver does not need to compute it at runtime,
+  # see autotents.preset.Geometry for details.
   # e.g.:
   # {
-  #   "2880x1440": {"16x16": {"row_bounds": [[a,b], [c,d], ...], "col_bounds": [[a,b], [c,d], ...]}}
+  #   "2880x1440": {"16x16": {"row_bounds": [[a,b], [c,d], ...], "col_bounds": [[a,b], [c,d], ...], "source_hash": "...",
+  #                           "row_digit_rects": ..., "col_digit_rects": ..., "tap_coords": ..., "board_bbox": ...}}
   # }
-  h, w = autotents.common.PRESET_SCREEN_DIM
-  print('Processing samples in parallel ...')
-  with multiprocessing.Pool() as p:
-    cell_bounds_mapping = dict(p.map(_generate_preset_for_size, autotents.common.PUZZLE_SIZES))
-  autotents.preset.preset.register(f'{h}x{w}', cell_bounds_mapping)
+  screen_dim = autotents.common.PRESET_SCREEN_DIM
+  h, w = screen_dim
+  screen_dim_raw = f'{h}x{w}'
+  existing = {} if force else autotents.preset.preset.data.get(screen_dim_raw, {})
+  # sizes that have no sample keep whatever is already in preset.
+  cell_bounds_mapping = dict(existing)
+  for size in autotents.common.PUZZLE_SIZES:
+    loc = sample_location(size, screen_dim)
+    if not os.path.exists(loc):
+      print(f'Sample for size {size} is not found, skipping ...')
+      continue
+    source_hash = file_hash(loc)
+    entry = existing.get(f'{size}x{size}')
+    if entry is not None and entry.get('source_hash') == source_hash:
+      if not all(field in entry for field in autotents.preset.GEOMETRY_FIELDS):
+        # preset generated before geometry is stored, no need to process sample again.
+        cell_bounds = (entry['row_bounds'], entry['col_bounds'])
+        cell_bounds_mapping[f'{size}x{size}'] = {**entry, **autotents.preset.build_geometry(cell_bounds)}
+      continue
+    print(f'Processing sample for size {size} ...')
+    size_raw, bound_info = _generate_preset_for_size(size, screen_dim, source_hash)
+    cell_bounds_mapping[size_raw] = bound_info
+
+  if cell_bounds_mapping == existing and screen_dim_raw in autotents.preset.preset.data:
+    print('Preset is up to date.')
+    return
+  autotents.preset.preset.register(screen_dim_raw, cell_bounds_mapping)
+
+
+# Verifying taps needs to tell a cell with a tent from one that is tapped only once,
+# which is done by comparing mean color of the cell with that of a known tent.
+# This is recorded from a screenshot with a tent at (row, col), as samples only have untouched boards.
+def main_record_tent_color(path, row, col):
+  img = cv2.imread(path)
+  assert img is not None, f'Cannot load {path}.'
+  h, w, _ = img.shape
+  screen_dim = (h, w)
+  size = autotents.preset.preset.findBoardSize(img, screen_dim)
+  assert size is not None, 'Size cannot be recognized.'
+  geometry = autotents.preset.preset.getGeometry(size, screen_dim)
+  [(top, left, bottom, right)] = autotents.common.cell_rects((geometry.row_bounds, geometry.col_bounds), [(row, col)])
+  color = [ round(x, 1) for x in cv2.mean(img[top:bottom, left:right])[:3] ]
+  print(f'Tent color of {h}x{w} is {color}.')
+  autotents.preset.preset.registerTentColor(screen_dim, color)
 
 
 if __name__ == '__main__':
-  main_generate_preset()
+  args = sys.argv[1:]
+  if len(args) == 4 and args[0] == 'tent':
+    main_record_tent_color(args[1], int(args[2]), int(args[3]))
+  else:
+    main_generate_preset(force=args == ['force'])
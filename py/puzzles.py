@@ -0,0 +1,46 @@
+#!/usr/bin/env python3.7
+"""Tool for the puzzle store (see autotents.records).
+
+Usage:
+
+- `./puzzles.py stats`: shows # of puzzles and average solving time by size.
+- `./puzzles.py list <size>`: prints all puzzles of a size, in the same format as legacy PUZZLE_RECORDS files.
+- `./puzzles.py import <file>`: imports a legacy PUZZLE_RECORDS file, puzzles already stored are not duplicated.
+"""
+
+import sys
+
+import autotents.records
+
+
+def main_stats(puzzles):
+  for size, count, solved_count, avg_solve_ms in puzzles.stats():
+    avg_desc = 'n/a' if avg_solve_ms is None else f'{avg_solve_ms:.1f}ms'
+    print(f'{size}x{size}: {count} puzzles, {solved_count} solved, average solving time {avg_desc}.')
+  print(f'Total: {puzzles.countPuzzles()} puzzles.')
+
+
+def main_list(puzzles, size):
+  for puzzle_id, input_lines, _ in puzzles.findPuzzlesBySize(size):
+    print(f'# {puzzle_id}')
+    for l in input_lines:
+      print(l)
+
+
+def main_import(puzzles, path):
+  total, new_count = puzzles.importLegacyRecords(path)
+  print(f'Imported {total} puzzles from {path}, {new_count} of them are new.')
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  puzzles = autotents.records.PuzzleStore()
+  if args == ['stats']:
+    main_stats(puzzles)
+  elif len(args) == 2 and args[0] == 'list':
+    main_list(puzzles, int(args[1]))
+  elif len(args) == 2 and args[0] == 'import':
+    main_import(puzzles, args[1])
+  else:
+    print(__doc__)
+    sys.exit(1)
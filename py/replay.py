@@ -0,0 +1,186 @@
+#!/usr/bin/env python3.7
+"""End-to-end replay of screenshot samples without a device.
+
+`FakeAgent` stands in for `input_agent_client.InputAgentClient`:
+it serves a screenshot sample as the screen and records every tap it receives with a timestamp.
+Taps are painted onto the screen, so that taps can be verified after tapping as on a device.
+Optionally every command takes some extra time, to simulate transport latency.
+
+Every screenshot under `private/samples/{h}x{w}/` (for the screen dim preset is built against)
+is shown in turn and played by the same code path as `./solver.py`, from taking screenshot to tapping.
+Time spent end-to-end is reported per puzzle.
+
+Usage: `./replay.py [raw] [latency in milliseconds]`
+
+With `raw`, screenshots are served as raw framebuffers rather than PNG files.
+
+Puzzle store is kept in memory, so every board goes through recognition and solving.
+"""
+
+import collections
+import os
+import re
+import sys
+import threading
+import time
+
+import cv2
+import numpy
+
+import autotents.common
+import autotents.digits
+import autotents.preset
+import autotents.records
+import autotents.screen
+import solver
+
+
+_SAMPLE_FILE_PATTERN = re.compile(r'^.*\.png$', re.IGNORECASE)
+
+_PERCENTILES = [50, 90, 99]
+
+
+# A tap received by FakeAgent, timestamp is taken from time.perf_counter.
+Tap = collections.namedtuple('Tap', ['timestamp', 'screen', 'coord'])
+
+
+class FakeAgent:
+  """Fake input agent, taps are painted onto the screen so that they can be verified.
+
+  Blank area around a point tapped once is filled with COLOR_TAPPED_ONCE, and twice with tent color
+  recorded in preset (see `./gen_preset.py tent`), or COLOR_TENT if there is none,
+  so that verification tells tents apart the same way as on a device.
+  Tapping a third time brings it back to blank.
+  """
+
+  COLOR_TAPPED_ONCE = (0x60, 0xa0, 0x60)
+  COLOR_TENT = (0x30, 0x60, 0xc0)
+
+  def __init__(self, latency=0.0, raw=False):
+    self.latency = latency
+    self.raw = raw
+    self.lock = threading.Lock()
+    self.screen = None
+    self.screen_img = None
+    self.tent_color = self.COLOR_TENT
+    self.screen_data = None
+    # coord -> # of taps received since current screen is shown.
+    self.tap_counts = collections.Counter()
+    self.taps = []
+
+  def show(self, path):
+    """Makes a screenshot file the current screen."""
+    img = cv2.imread(path)
+    if self.raw:
+      data = autotents.screen.encode_raw_framebuffer(img)
+    else:
+      with open(path, 'rb') as f:
+        data = f.read()
+    h, w, _ = img.shape
+    tent_color = autotents.preset.preset.getTentColor((h, w))
+    with self.lock:
+      self.screen = path
+      self.screen_img = img
+      self.tent_color = self.COLOR_TENT if tent_color is None else tent_color
+      self.screen_data = data
+      self.tap_counts.clear()
+
+  def render(self):
+    """Encodes current screen with taps painted onto it."""
+    img = self.screen_img.copy()
+    colors = [None, self.COLOR_TAPPED_ONCE, self.tent_color]
+    for coord, count in self.tap_counts.items():
+      color = colors[count % 3]
+      if color is not None:
+        cv2.floodFill(img, None, coord, color, loDiff=(0, 0, 0), upDiff=(0, 0, 0))
+    if self.raw:
+      return autotents.screen.encode_raw_framebuffer(img)
+    _, data = cv2.imencode('.png', img)
+    return data.tobytes()
+
+  def commandScreenshotAll(self):
+    time.sleep(self.latency)
+    with self.lock:
+      if self.screen_data is None:
+        self.screen_data = self.render()
+      return self.screen_data
+
+  def commandTap(self, coord):
+    time.sleep(self.latency)
+    with self.lock:
+      coord = tuple(coord)
+      self.taps.append(Tap(time.perf_counter(), self.screen, coord))
+      self.tap_counts[coord] += 1
+      # screen is rendered again on next screenshot.
+      self.screen_data = None
+
+
+def check_taps(taps, tent_positions):
+  """Checks that every tent is tapped exactly twice, returns an error message or None."""
+  if len(taps) != 2 * len(tent_positions):
+    return f'expected {2 * len(tent_positions)} taps, received {len(taps)}'
+  counts = collections.Counter(tap.coord for tap in taps)
+  if len(counts) != len(tent_positions) or any(count != 2 for count in counts.values()):
+    return 'some cells are not tapped exactly twice'
+  return None
+
+
+def main_replay(latency_ms=0.0, raw=False):
+  screen_dim = autotents.common.PRESET_SCREEN_DIM
+  h, w = screen_dim
+  samples_path = autotents.common.private_path('samples', f'{h}x{w}')
+  fnames = sorted(fname for fname in os.listdir(samples_path) if _SAMPLE_FILE_PATTERN.match(fname))
+
+  solve = solver.make_solver(solver.get_solver_backend())
+  agent = FakeAgent(latency_ms / 1000, raw)
+  puzzles = autotents.records.PuzzleStore(':memory:')
+  tap_interval = solver.get_tap_interval()
+  # assets are loaded before any timing takes place.
+  autotents.digits.get_manager()
+  autotents.preset.get_preset()
+
+  # list of (file name, end-to-end seconds, seconds to first tap)
+  results = []
+  failures = []
+  for fname in fnames:
+    agent.show(os.path.join(samples_path, fname))
+    tap_count = len(agent.taps)
+    start = time.perf_counter()
+    try:
+      tent_positions = solver.play_board(agent, solve, puzzles, tap_interval)
+    except AssertionError as e:
+      failures.append((fname, str(e)))
+      continue
+    end = time.perf_counter()
+    taps = agent.taps[tap_count:]
+    error = check_taps(taps, tent_positions)
+    if error is not None:
+      failures.append((fname, error))
+      continue
+    first_tap = taps[0].timestamp - start if taps else None
+    results.append((fname, end - start, first_tap))
+
+  print('# REPLAY REPORT BEGIN')
+  for fname, elapsed, first_tap in results:
+    first_tap_desc = 'n/a' if first_tap is None else f'{first_tap * 1000:.1f}ms'
+    print(f'{fname}: {elapsed * 1000:.1f}ms end-to-end, first tap at {first_tap_desc}.')
+  for fname, error in failures:
+    print(f'{fname}: failed, {error}')
+  if results:
+    elapsed_ms = numpy.array([ elapsed for _, elapsed, _ in results ]) * 1000
+    percentiles = ', '.join(f'p{p}={numpy.percentile(elapsed_ms, p):.1f}ms' for p in _PERCENTILES)
+    print(f'{len(results)} puzzles played, {len(failures)} failed. End-to-end: {percentiles}.')
+  print('# REPLAY REPORT END')
+  if failures:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  raw = args[:1] == ['raw']
+  if raw:
+    args = args[1:]
+  if len(args) > 1:
+    print(__doc__)
+    sys.exit(1)
+  main_replay(float(args[0]) if args else 0.0, raw)
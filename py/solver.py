@@ -1,21 +1,62 @@
 #!/usr/bin/env python3.7
 
+import collections
 import json
 import os
+import queue
 import random
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import uuid
 
 import cv2
 import numpy
-import input_agent_client
 
+import autotents.board
 import autotents.common
 import autotents.digits
 import autotents.preset
+import autotents.records
+import autotents.screen
+import autotents.tents
+import autotents.trace
+
+
+_SOLVER_BACKENDS = ['builtin', 'tents-demo']
+
+# How long to wait before taking another screenshot in loop mode when there is no new board.
+_LOOP_POLL_INTERVAL = 0.2
+
+# Max # of times loop mode tries to recognize and solve the same board before skipping it.
+_LOOP_MAX_ATTEMPTS = 3
+
+# Max # of times loop mode verifies taps on a board before leaving it to be finished by hand.
+_LOOP_MAX_VERIFICATIONS = 3
+
+# Default min interval in milliseconds between two taps.
+_TAP_INTERVAL_MS = 20
+
+# Seconds to wait after the last tap before taking a screenshot to verify taps, so that game has rendered them.
+_VERIFY_DELAY = 0.1
+
+# A solution cell is considered untouched if less than this fraction of its pixels changed after tapping.
+_CELL_CHANGED_FRACTION = 0.1
+
+# Max difference of a channel between mean color of a tent cell and recorded tent color.
+_TENT_COLOR_TOLERANCE = 16
+
+# seconds to wait for a device process to stop in multi-device mode.
+_WORKER_STOP_TIMEOUT = 2
+
+
+# A recognized puzzle, board is a list of rows of 'R' (tree) or '?',
+# row_digits and col_digits are lists of digit tags.
+# geometry is an autotents.preset.Geometry.
+# digit_scores are scores of row digits followed by col digits, None for empty digit cells.
+Puzzle = collections.namedtuple('Puzzle', ['size', 'geometry', 'board', 'row_digits', 'col_digits', 'digit_scores'])
 
 
 def get_tents_demo_bin():
@@ -25,24 +66,75 @@ def get_tents_demo_bin():
   return tents_demo_bin
 
 
-def load_realtime_screenshot(aia_client):
-  img_data = aia_client.commandScreenshotAll()
-  img_np = numpy.frombuffer(img_data, dtype=numpy.uint8)
-  img = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
-  return img
+def get_solver_backend():
+  """Gets name of the solver backend, which is either `builtin` or `tents-demo`.
 
-def main_recognize_and_solve_board():
-  tents_demo_bin = get_tents_demo_bin()
-  print(f'tents-demo: {tents_demo_bin}')
+  This is controlled by environment variable `TENTS_SOLVER`, when not set,
+  `tents-demo` is used if `TENTS_DEMO_BIN` is set, otherwise `builtin`.
+  """
+  default = 'tents-demo' if 'TENTS_DEMO_BIN' in os.environ else 'builtin'
+  backend = os.environ.get('TENTS_SOLVER', default)
+  assert backend in _SOLVER_BACKENDS, f'Unknown solver backend {backend}.'
+  return backend
 
-  if 'AIA_PORT' not in os.environ:
-    print('AIA_PORT is not set.')
-    sys.exit(1)
 
-  aia_client = input_agent_client.InputAgentClient(int(os.environ['AIA_PORT']))
+def solve_by_tents_demo(tents_demo_bin, input_lines):
+  proc_result = subprocess.run(
+    [tents_demo_bin, 'stdin'],
+    input='\n'.join(input_lines) + '\n',
+    text=True,
+    capture_output=True,
+  )
+  raw_tent_positions = proc_result.stdout.strip().split('|')
+  def parse_raw(raw):
+    [a,b] = raw.split(',')
+    return int(a), int(b)
+  return list(map(parse_raw, raw_tent_positions))
 
-  # take screenshot
-  img = load_realtime_screenshot(aia_client)
+
+def make_solver(backend):
+  """Returns a function that takes a Puzzle and returns tent positions."""
+  if backend == 'tents-demo':
+    tents_demo_bin = get_tents_demo_bin()
+    print(f'tents-demo: {tents_demo_bin}')
+    @autotents.trace.traced('solve')
+    def solve(puzzle):
+      return solve_by_tents_demo(tents_demo_bin, puzzle_input_lines(puzzle))
+    return solve
+
+  print('Using builtin solver.')
+  @autotents.trace.traced('solve')
+  def solve(puzzle):
+    tent_positions = autotents.tents.solve(puzzle.board, puzzle.row_digits, puzzle.col_digits)
+    assert tent_positions is not None, 'Puzzle has no solution.'
+    return tent_positions
+  return solve
+
+
+def get_aia_client(port=None):
+  """Connects to input agent on port, which defaults to AIA_PORT."""
+  if port is None:
+    if 'AIA_PORT' not in os.environ:
+      print('AIA_PORT is not set.')
+      sys.exit(1)
+    port = int(os.environ['AIA_PORT'])
+
+  # only needed when talking to a real device, so tools like replay.py work without it.
+  import input_agent_client
+  return input_agent_client.InputAgentClient(port)
+
+
+def load_realtime_screenshot(aia_client):
+  with autotents.trace.span('screenshot'):
+    img_data = aia_client.commandScreenshotAll()
+  with autotents.trace.span('imdecode'):
+    # for raw framebuffers, only rows that could contain a board are converted.
+    img = autotents.screen.decode_screenshot(img_data, autotents.preset.preset.getScreenRows)
+  return img
+
+
+def find_board(img):
+  """Determines screen_dim and size of the board, returns None if there is no board."""
   h, w, _ = img.shape
   # pick preset and determine screen_dim and size.
   screen_dim = (h, w)
@@ -50,48 +142,62 @@ def main_recognize_and_solve_board():
   assert screen_dim_raw in autotents.preset.preset.data, \
     f'Current preset does not contain info about screen size {screen_dim_raw}.'
   size = autotents.preset.preset.findBoardSize(img, screen_dim)
-  assert size is not None, 'Size cannot be recognized.'
-  print(f'Board size: {size}x{size}')
-  cell_bounds = autotents.preset.preset.getCellBounds(size, screen_dim)
-  row_bounds, col_bounds = cell_bounds
-  row_digits, col_digits = autotents.common.extract_digits(img, cell_bounds)
-
-  digits = numpy.concatenate(
-    [
-      numpy.concatenate(row_digits, axis=1),
-      numpy.concatenate(col_digits, axis=1),
-    ])
-
-  cells = [ [ None for _ in range(size) ] for _ in range(size)]
-  for r, (row_lo, row_hi) in enumerate(row_bounds):
-    for c, (col_lo, col_hi) in enumerate(col_bounds):
-      cells[r][c] = img[row_lo:row_hi+1, col_lo:col_hi+1]
-  recombined = numpy.concatenate([ numpy.concatenate(row, axis=1) for row in cells ], axis=0)
-
-  output_board = [ [ None for _ in range(size) ] for _ in range(size)]
-  def find_tree(cell_img,r,c):
-    result = autotents.common.find_exact_color(
-      cell_img, autotents.common.COLOR_TREE_SHADE)
-    (_,_,w,h) = cv2.boundingRect(result)
-    if w != 0 and h != 0:
-      color = 0xFF
-      output_board[r][c] = 'R'
-    else:
-      color = 0
-      output_board[r][c] = '?'
-    return numpy.full((4,4), color)
-
-  cell_results_recombined = numpy.concatenate([
-    numpy.concatenate([
-      find_tree(cell,r,c)
-      for c, cell in enumerate(row)
-    ], axis=1)
-    for r, row in enumerate(cells)
-  ], axis=0)
+  if size is None:
+    return None
+  return screen_dim, size
+
+
+def debug_plot_enabled():
+  """Tells whether to show what is extracted from the board.
+
+  This is controlled by environment variable `DEBUG_PLOT`, set it to `1` to enable.
+  """
+  return os.environ.get('DEBUG_PLOT') == '1'
+
+
+def plot_board(view, trees):
+  """Shows screenshot, cells, digits and trees found of a board, view is an autotents.board.BoardView."""
+  # matplotlib is only needed for debugging.
+  from matplotlib import pyplot
+
+  def subplot_color(pos, img, title):
+    pyplot.subplot(pos)
+    pyplot.imshow(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    pyplot.title(title)
+
+  def subplot_gray(pos, img, title):
+    pyplot.subplot(pos)
+    pyplot.imshow(img, cmap='gray')
+    pyplot.title(title)
+
+  pyplot.figure('@dev')
+  subplot_color(221, view.img, 'origin')
+  subplot_color(222, view.cellMosaic(), 'extracted')
+  subplot_color(223, view.digitMosaic(), 'digits')
+  subplot_gray(224, autotents.board.tree_mosaic(trees), 'find tree')
+  pyplot.show()
+
+
+def recognize_board(img, screen_dim, size, save_samples=True, use_cache=True, require_confident=True):
+  """Recognizes trees and digits of the board, returns a Puzzle.
+
+  Digits that are not recognized confidently are saved as untagged samples, unless save_samples is False.
+  Recognition result cache is neither looked up nor saved unless use_cache is True.
+  Unless require_confident is False, an AssertionError is raised if any digit is not recognized confidently.
+  """
+  geometry = autotents.preset.preset.getGeometry(size, screen_dim)
+  view = autotents.board.BoardView(img, geometry)
+  with autotents.trace.span('extract_digits'):
+    row_digits = view.rowDigits()
+    col_digits = view.colDigits()
+
+  trees = autotents.common.find_trees(img, (geometry.row_bounds, geometry.col_bounds))
+  output_board = numpy.where(trees, 'R', '?').tolist()
 
   # tagged_samples = load_samples()
   recog_row_digits = [ None for _ in range(size) ]
   recog_col_digits = [ None for _ in range(size) ]
+  digit_scores = []
 
   confident = True
   for desc, ds, ds_out in [
@@ -103,10 +209,12 @@ def main_recognize_and_solve_board():
       digit_img_cropped = autotents.common.crop_digit_cell(digit_img)
       if digit_img_cropped is None:
         ds_out[i] = '0'
+        digit_scores.append(None)
         continue
       # use original image for this step as we want some room around
       # the sample to allow some flexibility.
-      best_val, best_tag, competing_factor = autotents.digits.manager.findTag(digit_img)
+      best_val, best_tag, competing_factor = autotents.digits.manager.findTag(
+        digit_img, autotents.common.TM_METHOD, use_cache)
       if best_val is None or best_val < autotents.common.RECOG_THRESHOLD:
         confident = False
         need_to_save = True
@@ -115,7 +223,7 @@ def main_recognize_and_solve_board():
         confident = False
         need_to_save = True
         print(f'Warning: found a competing factor of {competing_factor}, proceed to sampling.')
-      if need_to_save:
+      if need_to_save and save_samples:
         nonce = str(uuid.uuid4())
         if best_val is None:
           fname = f'UNTAGGED_{nonce}.png'
@@ -129,69 +237,439 @@ def main_recognize_and_solve_board():
         cv2.imwrite(fpath, digit_img_cropped)
 
       ds_out[i] = best_tag
-  assert confident, 'Solving process stopped as recognition might be inaccurate.'
-  # Recognition is done, build up input to tents-demo
+      digit_scores.append(best_val)
+  if use_cache:
+    autotents.digits.manager.saveResultCache()
+  if debug_plot_enabled():
+    plot_board(view, trees)
+  assert confident or not require_confident, 'Solving process stopped as recognition might be inaccurate.'
+  return Puzzle(size, geometry, output_board, recog_row_digits, recog_col_digits, digit_scores)
+
+
+def puzzle_input_lines(puzzle):
+  """Builds up input to tents-demo, which is also the format used by puzzle records."""
   input_lines = []
   def out(line):
     input_lines.append(line)
 
-  out(f'{size} {size}')
-  for i, line in enumerate(output_board):
-    input_lines
-    out(''.join(line) + f' {recog_row_digits[i]}')
-  out(' '.join(recog_col_digits))
+  out(f'{puzzle.size} {puzzle.size}')
+  for i, line in enumerate(puzzle.board):
+    out(''.join(line) + f' {puzzle.row_digits[i]}')
+  out(' '.join(puzzle.col_digits))
+  return input_lines
+
+
+def print_puzzle(input_lines):
   print('# PUZZLE OUTPUT BEGIN')
   for l in input_lines:
     print(l)
   print('# PUZZLE OUTPUT END')
 
-  if confident and 'PUZZLE_RECORDS' in os.environ:
-    puzzle_file = os.environ['PUZZLE_RECORDS']
-    with open(puzzle_file, 'a') as f:
-      print(f'# {uuid.uuid4()}', file=f)
-      for l in input_lines:
-        print(l, file=f)
-    print(f'Recorded to {puzzle_file}.')
-  skip_solving = False
-  plot = False
-  if plot:
-    pyplot.figure().canvas.set_window_title('@dev')
-    subplot_color(221, img, 'origin')
-    subplot_color(222, recombined, 'extracted')
-    subplot_color(223, digits, 'digits')
-    subplot_gray(224, cell_results_recombined, 'find tree')
-    pyplot.show()
-  if skip_solving:
-    return
-  proc_result = subprocess.run(
-    [tents_demo_bin, 'stdin'],
-    input='\n'.join(input_lines) + '\n',
-    text=True,
-    capture_output=True,
-  )
-  raw_tent_positions = proc_result.stdout.strip().split('|')
-  def parse_raw(raw):
-    [a,b] = raw.split(',')
-    return int(a), int(b)
-  tent_positions = list(map(parse_raw, raw_tent_positions))
-  print(f'Received {len(tent_positions)} tent positions.')
-  # puzzle is solved, build up plan to tap cells as necessary
 
-  def tap(r,c):
-    row_lo, row_hi = row_bounds[r]
-    row_pos = round((row_lo + row_hi) / 2)
-    col_lo, col_hi = col_bounds[c]
-    col_pos = round((col_lo + col_hi) / 2)
-    coord = (col_pos, row_pos)
-    aia_client.commandTap(coord)
+def plan_taps(tap_coords, tent_positions):
+  """Builds up the list of screen coordinates to tap, every tent takes two taps.
 
+  tap_coords is a numpy array of shape (rows, cols, 2) as found in autotents.preset.Geometry.
+  """
   solving_moves = [ d for pos in tent_positions for d in [pos, pos] ]
   # shuffling doesn't actually do much, but looks a bit fancier.
   random.shuffle(solving_moves)
-  for (r,c) in solving_moves:
-    tap(r,c)
-    time.sleep(0.02)
+  if not solving_moves:
+    return []
+  rows, cols = zip(*solving_moves)
+  return [ (x, y) for x, y in tap_coords[list(rows), list(cols)].tolist() ]
+
+
+def get_tap_interval():
+  """Gets min interval in seconds between two taps.
+
+  This is controlled by environment variable `TAP_INTERVAL_MS`.
+  """
+  tap_interval_ms = float(os.environ.get('TAP_INTERVAL_MS', _TAP_INTERVAL_MS))
+  assert tap_interval_ms >= 0, 'TAP_INTERVAL_MS cannot be negative.'
+  return tap_interval_ms / 1000
+
+
+def dispatch_taps(aia_client, coords, tap_interval):
+  """Sends taps one after another, keeping them at least tap_interval apart.
+
+  commandTap returns once input agent has acknowledged the tap, so time spent
+  on that round trip counts towards the interval and we only sleep for what is left.
+  When input agent gets slow, taps are paced by acknowledgements alone.
+  """
+  last_sent = None
+  for coord in coords:
+    if last_sent is not None:
+      remaining = tap_interval - (time.monotonic() - last_sent)
+      if remaining > 0:
+        time.sleep(remaining)
+    last_sent = time.monotonic()
+    aia_client.commandTap(coord)
+
+
+def find_missing_taps(before, after, geometry, tent_positions, tent_color):
+  """Compares solution cells before and after tapping, returns a list of (tent position, # of taps it still needs).
+
+  A cell that did not change received none of its taps.
+  A cell that changed received one or both of them, it is a tent if its mean color is close to tent_color,
+  and otherwise has only received its first tap. Without tent_color, changed cells are left as they are.
+  """
+  rects = autotents.common.cell_rects((geometry.row_bounds, geometry.col_bounds), tent_positions)
+  fractions = autotents.common.changed_fractions(before, after, rects)
+  missing = []
+  for pos, (top, left, bottom, right), fraction in zip(tent_positions, rects, fractions):
+    if fraction < _CELL_CHANGED_FRACTION:
+      missing.append((pos, 2))
+    elif tent_color is not None:
+      color = cv2.mean(after[top:bottom, left:right])[:3]
+      if numpy.abs(numpy.subtract(color, tent_color)).max() > _TENT_COLOR_TOLERANCE:
+        missing.append((pos, 1))
+  return missing
+
+
+@autotents.trace.traced('verify')
+def verify_taps(aia_client, before, geometry, tent_positions, tap_interval):
+  """Takes one screenshot after tapping, and taps again tents that are not placed.
+
+  before is the screenshot the board is recognized from.
+  Returns True if the board is complete, which is the case when no digit is left unsatisfied,
+  or when the board is no longer shown.
+  """
+  time.sleep(_VERIFY_DELAY)
+  after = load_realtime_screenshot(aia_client)
+  cell_bounds = (geometry.row_bounds, geometry.col_bounds)
+  if before.shape != after.shape:
+    return True
+  trees_before = autotents.common.find_trees(before, cell_bounds)
+  if not numpy.array_equal(trees_before, autotents.common.find_trees(after, cell_bounds)):
+    return True
+  digit_rects = [geometry.row_digit_rects, geometry.col_digit_rects]
+  if not any(autotents.common.has_unsat_digits(after, rects) for rects in digit_rects):
+    return True
+  h, w, _ = after.shape
+  tent_color = autotents.preset.preset.getTentColor((h, w))
+  if tent_color is None:
+    print('Tent color is not recorded, only tents that received none of their taps are tapped again.')
+  missing = find_missing_taps(before, after, geometry, tent_positions, tent_color)
+  autotents.trace.count('retaps', sum(tap_count for _, tap_count in missing))
+  if missing:
+    print(f'{len(missing)} tents are not placed, tapping them again.')
+    coords = [ tuple(geometry.tap_coords[r, c].tolist()) for (r, c), tap_count in missing for _ in range(tap_count) ]
+    dispatch_taps(aia_client, coords, tap_interval)
+  return False
+
+
+@autotents.trace.traced('tap')
+def tap_solution(aia_client, geometry, tent_positions, tap_interval=None, before=None):
+  """Taps tents onto the board.
+
+  If before, the screenshot the board is recognized from, is given, taps are verified afterwards (see verify_taps).
+  Returns whether the board is known to be complete.
+  """
+  if tap_interval is None:
+    tap_interval = get_tap_interval()
+  dispatch_taps(aia_client, plan_taps(geometry.tap_coords, tent_positions), tap_interval)
+  if before is None:
+    return False
+  complete = verify_taps(aia_client, before, geometry, tent_positions, tap_interval)
+  autotents.trace.annotate(complete=complete)
+  return complete
+
+
+def solve_board(img, screen_dim, size, solve, puzzles, save_samples=True):
+  """Recognizes and solves a board, returns (geometry, tent positions).
+
+  puzzles is an autotents.records.PuzzleStore, boards found in it are not recognized or solved again.
+  save_samples is passed to recognize_board.
+  """
+  geometry = autotents.preset.preset.getGeometry(size, screen_dim)
+  with autotents.trace.span('board_fingerprint'):
+    fingerprint = autotents.records.board_fingerprint(img, screen_dim, size, geometry)
+  tent_positions = puzzles.findSolution(fingerprint)
+  if tent_positions is not None:
+    print('This board is solved before, using recorded solution.')
+    autotents.trace.annotate(board_cache_hit=True)
+    return geometry, tent_positions
+  start = time.perf_counter()
+  puzzle = recognize_board(img, screen_dim, size, save_samples)
+  recognize_ms = (time.perf_counter() - start) * 1000
+  input_lines = puzzle_input_lines(puzzle)
+  print_puzzle(input_lines)
+  start = time.perf_counter()
+  tent_positions = solve(puzzle)
+  solve_ms = (time.perf_counter() - start) * 1000
+  puzzles.addSolved(fingerprint, input_lines, tent_positions, puzzle.digit_scores, recognize_ms, solve_ms)
+  return geometry, tent_positions
+
+
+def play_board(aia_client, solve, puzzles, tap_interval=None, skip_solving=False):
+  """Takes a screenshot, then recognizes, solves and taps the board on it.
+
+  Returns tent positions, or None if skip_solving is True.
+  """
+  trace = autotents.trace.begin('solve_board')
+
+  # take screenshot
+  img = load_realtime_screenshot(aia_client)
+  board = find_board(img)
+  assert board is not None, 'Size cannot be recognized.'
+  screen_dim, size = board
+  print(f'Board size: {size}x{size}')
+  autotents.trace.annotate(size=size)
+
+  if skip_solving:
+    puzzle = recognize_board(img, screen_dim, size)
+    input_lines = puzzle_input_lines(puzzle)
+    print_puzzle(input_lines)
+    puzzles.addPuzzle(input_lines)
+    autotents.trace.finish(trace)
+    return None
+  geometry, tent_positions = solve_board(img, screen_dim, size, solve, puzzles)
+  print(f'Received {len(tent_positions)} tent positions.')
+  # puzzle is solved, build up plan to tap cells as necessary
+  if tap_solution(aia_client, geometry, tent_positions, tap_interval, before=img):
+    print('Board is complete.')
+  autotents.trace.finish(trace)
+  return tent_positions
+
+
+def main_recognize_and_solve_board():
+  solve = make_solver(get_solver_backend())
+  aia_client = get_aia_client()
+  puzzles = autotents.records.PuzzleStore()
+  skip_solving = False
+  play_board(aia_client, solve, puzzles, skip_solving=skip_solving)
+
+
+class _LockedClient:
+  """Serializes commands to input agent, as stages of loop mode share one client."""
+
+  def __init__(self, aia_client):
+    self.aia_client = aia_client
+    self.lock = threading.Lock()
+
+  def commandScreenshotAll(self):
+    with self.lock:
+      return self.aia_client.commandScreenshotAll()
+
+  def commandTap(self, coord):
+    with self.lock:
+      return self.aia_client.commandTap(coord)
+
+
+def run_play_loop(aia_client, solve, puzzles, stop, on_solved, tap_interval=None):
+  """Solves puzzles continuously until stop (a threading.Event) is set.
+
+  This runs as a pipeline of three stages, each in its own thread:
+
+  - capture: takes screenshots until a board that is not yet seen shows up.
+    This keeps going while taps are being sent, so the next board is captured and recognized
+    as soon as the game shows it, while tap stage might still be verifying the previous one.
+  - solve: recognizes and solves the board.
+    A board that fails is captured again, as the screenshot might be taken in the middle of an animation,
+    but only if it looks different from the last failed attempt, and at most _LOOP_MAX_ATTEMPTS times.
+    Untagged samples are only saved on the first attempt.
+  - tap: taps tents onto the board, then verifies them with one more screenshot.
+    A board that is not complete yet is verified again, up to _LOOP_MAX_VERIFICATIONS times in total,
+    as the game might not have moved on when the screenshot is taken.
+    A board that is still not complete stays on screen until it is finished by hand,
+    capture stage picks up the next board from there.
+
+  Stages are connected by queues holding at most one item, so a stage
+  waits for the next one to catch up instead of piling up work.
+  on_solved is called with seconds from capturing a board to finishing tapping it, only for complete boards.
+  """
+  if tap_interval is None:
+    tap_interval = get_tap_interval()
+  aia_client = _LockedClient(aia_client)
+  boards = queue.Queue(maxsize=1)
+  solutions = queue.Queue(maxsize=1)
+  # key of the last board sent to solve stage.
+  last_key = None
+  # (key, # of attempts, fingerprint of last attempt) of the board that last failed.
+  failure = (None, 0, None)
+
+  def capture():
+    nonlocal last_key
+    while not stop.is_set():
+      # a trace is only kept if this screenshot turns out to be a new board.
+      trace = autotents.trace.begin('solve_board')
+      captured = time.perf_counter()
+      img = load_realtime_screenshot(aia_client)
+      board = find_board(img)
+      if board is not None:
+        screen_dim, size = board
+        # trees do not change while we are tapping on a board, so they tell boards apart.
+        geometry = autotents.preset.preset.getGeometry(size, screen_dim)
+        key = (size, autotents.common.find_trees(img, (geometry.row_bounds, geometry.col_bounds)).tobytes())
+        if key != last_key:
+          last_key = key
+          autotents.trace.annotate(size=size)
+          boards.put((trace, captured, key, img, screen_dim, size))
+          continue
+      time.sleep(_LOOP_POLL_INTERVAL)
+
+  def recognize_and_solve():
+    nonlocal last_key, failure
+    while not stop.is_set():
+      trace, captured, key, img, screen_dim, size = boards.get()
+      autotents.trace.resume(trace)
+      print(f'Board size: {size}x{size}')
+      failed_key, attempts, last_fingerprint = failure
+      if failed_key != key:
+        attempts, last_fingerprint = 0, None
+      try:
+        geometry, tent_positions = solve_board(img, screen_dim, size, solve, puzzles, save_samples=attempts == 0)
+      except AssertionError as e:
+        autotents.trace.finish(trace, error=str(e))
+        geometry = autotents.preset.preset.getGeometry(size, screen_dim)
+        fingerprint = autotents.records.board_fingerprint(img, screen_dim, size, geometry)
+        attempts += 1
+        failure = (key, attempts, fingerprint)
+        # the same pixels are recognized the same way, only a board that changed might be in the middle of an animation.
+        if fingerprint == last_fingerprint or attempts >= _LOOP_MAX_ATTEMPTS:
+          print(f'Skipping board after {attempts} attempts: {e}')
+        else:
+          print(f'Failed to solve board, capturing it again: {e}')
+          # capture stage might have moved on to another board.
+          if last_key == key:
+            last_key = None
+        continue
+      solutions.put((trace, captured, img, geometry, tent_positions))
+
+  def tap():
+    while not stop.is_set():
+      trace, captured, img, geometry, tent_positions = solutions.get()
+      autotents.trace.resume(trace)
+      complete = tap_solution(aia_client, geometry, tent_positions, tap_interval, before=img)
+      verifications = 1
+      while not complete and verifications < _LOOP_MAX_VERIFICATIONS and not stop.is_set():
+        time.sleep(_LOOP_POLL_INTERVAL)
+        complete = verify_taps(aia_client, img, geometry, tent_positions, tap_interval)
+        verifications += 1
+      autotents.trace.annotate(complete=complete, verifications=verifications)
+      autotents.trace.finish(trace)
+      if not complete:
+        print(f'Board is not complete after {verifications} verifications, finish it by hand to move on.')
+        continue
+      on_solved(time.perf_counter() - captured)
+
+  workers = [ threading.Thread(target=f, daemon=True) for f in [capture, recognize_and_solve, tap] ]
+  for worker in workers:
+    worker.start()
+  while not stop.is_set() and all(worker.is_alive() for worker in workers):
+    time.sleep(_LOOP_POLL_INTERVAL)
+  stop.set()
+
+
+def main_play_loop():
+  """Solves puzzles continuously on the device of AIA_PORT, see run_play_loop.
+
+  Stop with Ctrl-C.
+  """
+  solve = make_solver(get_solver_backend())
+  puzzles = autotents.records.PuzzleStore()
+  aia_client = get_aia_client()
+  stop = threading.Event()
+
+  solved_count = 0
+  def on_solved(latency):
+    nonlocal solved_count
+    solved_count += 1
+    report()
+
+  start_time = time.time()
+  def report():
+    elapsed = time.time() - start_time
+    print(f'Solved {solved_count} puzzles in {elapsed:.1f}s, {solved_count * 60 / elapsed:.2f} puzzles per minute.')
+
+  try:
+    run_play_loop(aia_client, solve, puzzles, stop, on_solved, get_tap_interval())
+  except KeyboardInterrupt:
+    pass
+  stop.set()
+  report()
+
+
+def _device_worker(port, solver_backend, tap_interval, results):
+  """Entry point of a device process in multi-device mode.
+
+  Every solved puzzle is reported to results as (port, latency in seconds).
+  """
+  solve = make_solver(solver_backend)
+  # SQLite connections must not be shared across processes, so every device opens its own.
+  puzzles = autotents.records.PuzzleStore()
+  stop = threading.Event()
+  try:
+    run_play_loop(get_aia_client(port), solve, puzzles, stop, lambda latency: results.put((port, latency)), tap_interval)
+  except KeyboardInterrupt:
+    pass
+  stop.set()
+
+
+def main_multi_device(ports):
+  """Solves puzzles continuously on several devices, one process for each agent port.
+
+  Digit samples and preset are loaded before device processes are forked, so
+  they are shared through copy-on-write memory rather than loaded again per device.
+  Throughput of all devices and latency of each device are reported as puzzles are solved.
+  Stop with Ctrl-C.
+  """
+  import multiprocessing
+
+  solver_backend = get_solver_backend()
+  tap_interval = get_tap_interval()
+  autotents.digits.get_manager()
+  autotents.preset.get_preset()
+
+  context = multiprocessing.get_context('fork')
+  results = context.Queue()
+  workers = [
+    context.Process(target=_device_worker, args=(port, solver_backend, tap_interval, results), daemon=True)
+    for port in ports
+  ]
+  for worker in workers:
+    worker.start()
+
+  # port -> list of latencies in seconds
+  latencies = { port: [] for port in ports }
+  start_time = time.time()
+  def report():
+    elapsed = time.time() - start_time
+    total = sum(len(l) for l in latencies.values())
+    print(f'Solved {total} puzzles on {len(ports)} devices in {elapsed:.1f}s, {total * 60 / elapsed:.2f} puzzles per minute.')
+    for port, port_latencies in latencies.items():
+      if port_latencies:
+        latency_ms = numpy.array(port_latencies) * 1000
+        print(
+          f'  Device {port}: {len(port_latencies)} puzzles,'
+          f' latency p50={numpy.percentile(latency_ms, 50):.1f}ms, p90={numpy.percentile(latency_ms, 90):.1f}ms.')
+      else:
+        print(f'  Device {port}: no puzzle solved.')
+
+  try:
+    while any(worker.is_alive() for worker in workers):
+      try:
+        port, latency = results.get(timeout=1)
+      except queue.Empty:
+        continue
+      latencies[port].append(latency)
+      report()
+  except KeyboardInterrupt:
+    pass
+  for worker in workers:
+    # Ctrl-C reaches device processes too, those that are not stopped by it are terminated.
+    worker.join(_WORKER_STOP_TIMEOUT)
+    if worker.is_alive():
+      worker.terminate()
+  report()
 
 
 if __name__ == '__main__':
-  main_recognize_and_solve_board()
+  args = sys.argv[1:]
+  if args == ['loop']:
+    main_play_loop()
+  elif len(args) >= 2 and args[0] == 'multi':
+    main_multi_device([ int(port) for port in args[1:] ])
+  else:
+    main_recognize_and_solve_board()
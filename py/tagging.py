@@ -11,6 +11,7 @@ as untagged digits can be removed once recorded digits can match them.
 
 import collections
 import functools
+import multiprocessing
 import os
 import re
 import sys
@@ -26,30 +27,82 @@ import autotents.digits
 _SAMPLE_FILE_PATTERN = re.compile(r'^.*\.png$', re.IGNORECASE)
 
 
-def get_all_samples(screen_dim):
+# Max # of screenshots being processed or waiting to be consumed at any time.
+# os.cpu_count() is None when # of CPUs cannot be determined.
+_PIPELINE_DEPTH = 2 * (os.cpu_count() or 1)
+
+
+def list_sample_names(screen_dim):
   h, w = screen_dim
-  retd = collections.defaultdict(list)
   # for this step all samples are participating.
-  for fname in os.listdir(autotents.common.private_path('samples', f'{h}x{w}')):
-    if _SAMPLE_FILE_PATTERN.match(fname) is None:
-      continue
-    try:
-      img = autotents.common.load_sample_by_name(
-        fname,
-        autotents.common.PRESET_SCREEN_DIM
-      )
-      assert img is not None
-    except:
-      msg = sys.exc_info()[0]
-      print(f'Sample {fname} failed to load due to error {msg}, skipping ...')
+  # names are sorted so that output does not depend on directory order.
+  return sorted(
+    fname
+    for fname in os.listdir(autotents.common.private_path('samples', f'{h}x{w}'))
+    if _SAMPLE_FILE_PATTERN.match(fname) is not None
+  )
+
+
+def process_sample(fname, screen_dim):
+  """Loads a screenshot and recognizes its digits.
+
+  Returns (size, list of (cropped digit, best_val, best_tag, competing_factor)),
+  or None if the sample cannot be used.
+  Full screenshot is dropped here so only cropped digits are sent back.
+  """
+  try:
+    img = autotents.common.load_sample_by_name(fname, screen_dim)
+    assert img is not None
+  except:
+    msg = sys.exc_info()[0]
+    print(f'Sample {fname} failed to load due to error {msg}, skipping ...')
+    return None
+  size = autotents.preset.preset.findBoardSize(img, screen_dim)
+  if size is None:
+    print(f'Skipping sample {fname} as we cannot determine its size ...')
+    return None
+  cell_bounds = autotents.preset.preset.getCellBounds(size, screen_dim)
+  row_digits, col_digits = autotents.common.extract_digits(img, cell_bounds)
+  results = []
+  for digit_img in row_digits + col_digits:
+    digit_img_cropped = autotents.common.crop_digit_cell(digit_img)
+    if digit_img_cropped is None:
       continue
-    size = autotents.preset.preset.findBoardSize(img, screen_dim)
-    if size is None:
-      print(f'Skipping sample {fname} as we cannot determine its size ...')
-      continue
-    retd[size].append((fname, img))
-  # returns a sorted list of (size, list of <file name and img instance pair>)
-  return sorted(retd.items(), key=lambda x: x[0])
+    # use original image for this step as we want some room around
+    # the sample to allow some flexibility.
+    best_val, best_tag, competing_factor = autotents.digits.manager.findTag(digit_img)
+    results.append((digit_img_cropped, best_val, best_tag, competing_factor))
+  return size, results
+
+
+def _process_sample_task(task):
+  fname, screen_dim = task
+  return fname, process_sample(fname, screen_dim)
+
+
+def bounded_imap(pool, f, items, depth):
+  """Like pool.imap, but at most depth items are submitted and not yet consumed.
+
+  Pool.imap submits all items at once, so results pile up
+  if they are produced faster than being consumed.
+  """
+  pending = collections.deque()
+  for item in items:
+    if len(pending) >= depth:
+      yield pending.popleft().get()
+    pending.append(pool.apply_async(f, (item,)))
+  while pending:
+    yield pending.popleft().get()
+
+
+def iter_processed_samples(screen_dim):
+  """Yields (file name, result of process_sample) in file name order, processing is done by a worker pool."""
+  # assets are loaded before forking so that workers inherit them rather than loading their own.
+  autotents.digits.get_manager()
+  autotents.preset.get_preset()
+  tasks = [ (fname, screen_dim) for fname in list_sample_names(screen_dim) ]
+  with multiprocessing.Pool() as pool:
+    yield from bounded_imap(pool, _process_sample_task, tasks, _PIPELINE_DEPTH)
 
 
 def main_tagging(dry_run=True):
@@ -58,7 +111,6 @@ def main_tagging(dry_run=True):
   print(f'Loaded {len(tagged_samples)} tags, {sample_count} tagged samples in total.')
 
   screen_dim = autotents.common.PRESET_SCREEN_DIM
-  scr_h, scr_w = screen_dim
 
   # limit the # of samples stored to disk per function call.
   # for now this is effectively not doing anything but we want to avoid
@@ -72,53 +124,46 @@ def main_tagging(dry_run=True):
 
   min_competing_factor = None
   autotents.digits.manager.cleanUpUntagged()
-  for size, samples in get_all_samples(screen_dim):
+  # results are consumed in a fixed order, so the same samples are stored
+  # regardless of which worker finishes first.
+  for fname, result in iter_processed_samples(screen_dim):
     if store_quota <= 0:
       break
-    print(f'Working on size {size} ...')
-    cell_bounds = autotents.preset.preset.getCellBounds(size, screen_dim)
-    for fname, img in samples:
-      if store_quota <= 0:
-        break
-      print(f'Processing {fname} ...')
-      row_digits, col_digits = autotents.common.extract_digits(img, cell_bounds)
-      for digit_img in row_digits + col_digits:
-        digit_img_cropped = autotents.common.crop_digit_cell(digit_img)
-        if digit_img_cropped is None:
+    if result is None:
+      continue
+    size, digit_results = result
+    print(f'Processing {fname} (size {size}) ...')
+    for digit_img_cropped, best_val, best_tag, competing_factor in digit_results:
+      visit_count += 1
+      if competing_factor is not None and (
+          min_competing_factor is None or min_competing_factor > competing_factor
+      ):
+        min_competing_factor = competing_factor
+      if best_val is not None and best_val >= autotents.common.RECOG_THRESHOLD:
+        if competing_factor is None:
+          good_count += 1
           continue
-        visit_count += 1
-        # use original image for this step as we want some room around
-        # the sample to allow some flexibility.
-        best_val, best_tag, competing_factor = autotents.digits.manager.findTag(digit_img)
-        if competing_factor is not None and (
-            min_competing_factor is None or min_competing_factor > competing_factor
-        ):
-          min_competing_factor = competing_factor
-        if best_val is not None and best_val >= autotents.common.RECOG_THRESHOLD:
-          if competing_factor is None:
-            good_count += 1
-            continue
-          else:
-            print(f'Found a completing factor of {competing_factor}, proceed to sampling.')
-
-        nonce = str(uuid.uuid4())
-        if best_val is None:
-          print(f'Found new sample with no good guesses.')
-          fname = f'UNTAGGED_{nonce}.png'
         else:
-          print(f'Found new sample with best guess being {best_tag}, with score {best_val}')
-          # attach the suspected tag here so it is more convenient when it is actually correct.
-          fname = f'UNTAGGED_{best_tag}_{nonce}.png'
-
-        fpath = os.path.join(store_path, fname)
-        if dry_run:
-          print(f'(Dry run) Saving a sample shaped {digit_img_cropped.shape} to {fpath}...')
-        else:
-          print(f'Saving a sample shaped {digit_img_cropped.shape} to {fpath}...')
-          cv2.imwrite(fpath, digit_img_cropped)
-        store_quota -= 1
-        if store_quota <= 0:
-          break
+          print(f'Found a completing factor of {competing_factor}, proceed to sampling.')
+
+      nonce = str(uuid.uuid4())
+      if best_val is None:
+        print(f'Found new sample with no good guesses.')
+        fname = f'UNTAGGED_{nonce}.png'
+      else:
+        print(f'Found new sample with best guess being {best_tag}, with score {best_val}')
+        # attach the suspected tag here so it is more convenient when it is actually correct.
+        fname = f'UNTAGGED_{best_tag}_{nonce}.png'
+
+      fpath = os.path.join(store_path, fname)
+      if dry_run:
+        print(f'(Dry run) Saving a sample shaped {digit_img_cropped.shape} to {fpath}...')
+      else:
+        print(f'Saving a sample shaped {digit_img_cropped.shape} to {fpath}...')
+        cv2.imwrite(fpath, digit_img_cropped)
+      store_quota -= 1
+      if store_quota <= 0:
+        break
 
   print(f'Store quota is now {store_quota}.')
   print(f'Visited {visit_count} samples and {good_count} of them found good matches.')